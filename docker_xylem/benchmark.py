@@ -0,0 +1,223 @@
+"""
+Load test a DockerService over a temporary UNIX socket.
+
+Mount and umount are replaced with a fake which takes a configurable time
+and xylem is replaced by a local HTTP server, so the benchmark measures
+the plugin itself. Run it with::
+
+    python -m docker_xylem.benchmark --containers 1000 --concurrency 50
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import tempfile
+
+from twisted.internet import defer, reactor, task
+from twisted.python import usage
+from twisted.web import server, resource
+
+from docker_xylem import utils
+from docker_xylem.service import DockerService
+
+ENDPOINTS = ('Create', 'Mount', 'Path', 'Get', 'List', 'Unmount')
+
+
+class Options(usage.Options):
+    optParameters = [
+        ["containers", "n", 1000, "Containers to start and stop", int],
+        ["concurrency", "c", 50, "Containers started concurrently", int],
+        ["volumes", "v", 10, "Distinct volumes shared by containers", int],
+        ["mount-latency", None, 0.05, "Seconds taken by mount", float],
+        ["xylem-latency", None, 0.1, "Seconds taken by xylem", float],
+        ["polls", None, 3, "Get and List polls per container", int],
+    ]
+    optFlags = [
+        ["fork", None, "Fork a process for every mount and umount"],
+    ]
+
+
+class FakeXylem(resource.Resource):
+    """ Stand-in xylem server which answers queue calls after a delay
+    """
+    isLeaf = True
+
+    def __init__(self, latency):
+        resource.Resource.__init__(self)
+        self.latency = latency
+        self.volumes = set()
+
+    def render_POST(self, request):
+        call = request.path.rstrip('/').split('/')[-1]
+        data = json.loads(request.content.read() or '{}')
+
+        if call == 'createvolume':
+            self.volumes.add(data['name'])
+            result = {'result': {
+                'bricks': ['localhost:/data/%s' % data['name']],
+                'running': True,
+                'id': data['name']
+            }}
+        elif call == 'listvolumes':
+            result = {'result': sorted(self.volumes)}
+        else:
+            result = {}
+
+        def finish():
+            request.setHeader("content-type", "application/json")
+            request.write(json.dumps(result))
+            request.finish()
+
+        reactor.callLater(self.latency, finish)
+        return server.NOT_DONE_YET
+
+
+def fake_fork(latency, fork=False):
+    """ Replacement for DockerService._fork
+    """
+    def _fork(executable, args=(), **kw):
+        if fork:
+            return utils.fork(
+                '/bin/sh', args=('-c', 'sleep %s' % latency), timeout=60)
+        return task.deferLater(reactor, latency, lambda: ("", "", 0))
+    return _fork
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    index = int(round(pct / 100.0 * (len(values) - 1)))
+    return values[index]
+
+
+class Benchmark(object):
+    def __init__(self, containers=1000, concurrency=50, volumes=10,
+                 mount_latency=0.05, xylem_latency=0.1, polls=3, fork=False):
+        self.containers = containers
+        self.concurrency = concurrency
+        self.volumes = volumes
+        self.mount_latency = mount_latency
+        self.xylem_latency = xylem_latency
+        self.polls = polls
+        self.fork = fork
+
+        self.latencies = dict((e, []) for e in ENDPOINTS)
+        self.errors = dict((e, 0) for e in ENDPOINTS)
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp(prefix='docker-xylem-bench-')
+        self.socket = os.path.join(self.tmp, 'xylem.sock')
+
+        self.xylem = reactor.listenTCP(
+            0, server.Site(FakeXylem(self.xylem_latency)),
+            interface='127.0.0.1')
+
+        self.service = DockerService({
+            'host': '127.0.0.1',
+            'port': self.xylem.getHost().port,
+            'mount_path': os.path.join(self.tmp, 'volumes'),
+            'mountinfo': None,
+            'state_journal': os.path.join(self.tmp, 'state'),
+            'catalog_refresh': 0,
+        })
+        self.service._fork = fake_fork(self.mount_latency, self.fork)
+        self.service.start()
+
+        self.plugin = reactor.listenUNIX(
+            self.socket, server.Site(self.service))
+        self.pool = utils.connection_pool(max_per_host=self.concurrency)
+
+    @defer.inlineCallbacks
+    def tearDown(self):
+        yield self.plugin.stopListening()
+        yield self.xylem.stopListening()
+        yield self.pool.closeCachedConnections()
+        yield self.service.stop()
+        shutil.rmtree(self.tmp)
+
+    @defer.inlineCallbacks
+    def call(self, endpoint, data):
+        start = time.time()
+        result = yield utils.HTTPRequest(timeout=60, pool=self.pool).getJson(
+            'http://plugin/VolumeDriver.%s' % endpoint,
+            method='POST',
+            data=json.dumps(data),
+            socket='unix:%s' % self.socket
+        )
+        self.latencies[endpoint].append(time.time() - start)
+        if result.get('Err'):
+            self.errors[endpoint] += 1
+        defer.returnValue(result)
+
+    @defer.inlineCallbacks
+    def container(self, index):
+        """ Make the calls Docker makes to run and stop one container
+        """
+        name = 'benchvol%s' % random.randrange(self.volumes)
+        mount = {'Name': name, 'ID': 'container%s' % index}
+
+        yield self.call('Create', {'Name': name, 'Opts': {}})
+        yield self.call('Mount', mount)
+        yield self.call('Path', {'Name': name})
+        for i in range(self.polls):
+            yield self.call('Get', {'Name': name})
+            yield self.call('List', {})
+        yield self.call('Unmount', mount)
+
+    @defer.inlineCallbacks
+    def run(self):
+        """ Run the benchmark and return the time it took
+        """
+        self.setUp()
+        try:
+            work = (self.container(i) for i in range(self.containers))
+            coop = task.Cooperator()
+            start = time.time()
+            yield defer.gatherResults([
+                coop.coiterate(work) for i in range(self.concurrency)
+            ])
+            elapsed = time.time() - start
+        finally:
+            yield self.tearDown()
+
+        defer.returnValue(elapsed)
+
+    def report(self, elapsed, out=sys.stdout):
+        calls = sum(len(v) for v in self.latencies.values())
+        out.write('%s containers, %s calls in %.2fs (%.1f calls/s)\n' % (
+            self.containers, calls, elapsed, calls / elapsed))
+        out.write('%-10s %8s %7s %10s %10s %10s\n' % (
+            'endpoint', 'calls', 'errors', 'p50 ms', 'p99 ms', 'p999 ms'))
+        for endpoint in ENDPOINTS:
+            values = self.latencies[endpoint]
+            out.write('%-10s %8d %7d %10.2f %10.2f %10.2f\n' % (
+                endpoint, len(values), self.errors[endpoint],
+                percentile(values, 50) * 1000,
+                percentile(values, 99) * 1000,
+                percentile(values, 99.9) * 1000))
+
+
+@defer.inlineCallbacks
+def main(reactor, *argv):
+    options = Options()
+    options.parseOptions(argv)
+
+    bench = Benchmark(
+        containers=options['containers'],
+        concurrency=options['concurrency'],
+        volumes=options['volumes'],
+        mount_latency=options['mount-latency'],
+        xylem_latency=options['xylem-latency'],
+        polls=options['polls'],
+        fork=options['fork'],
+    )
+    elapsed = yield bench.run()
+    bench.report(elapsed)
+
+
+if __name__ == '__main__':
+    task.react(main, sys.argv[1:])
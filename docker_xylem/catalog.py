@@ -0,0 +1,110 @@
+from twisted.internet import defer, reactor, task
+
+from docker_xylem.compat import Logger
+from docker_xylem.metrics import REGISTRY
+
+CREATE_CACHE = REGISTRY.counter(
+    'docker_xylem_create_cache_total',
+    'Create calls answered from the cache or sent to xylem', ['result'])
+
+
+class VolumeCatalog(object):
+    """Cache of the volumes known to xylem across the cluster
+
+    The catalog is replaced in the background every `interval` seconds by
+    calling `fetch`, which returns a Deferred firing with a list of volume
+    names. Creates and Removes on this host update it in between. Entries
+    which have not been confirmed for `ttl` seconds are ignored, so a
+    catalog which can no longer be refreshed empties itself.
+    """
+    def __init__(self, fetch, interval=60, ttl=300, clock=reactor):
+        self.log = Logger()
+        self.fetch = fetch
+        self.interval = interval
+        self.ttl = ttl
+        self.clock = clock
+        self.volumes = {}
+        self.loop = None
+
+    def start(self):
+        if self.interval:
+            self.loop = task.LoopingCall(self.refresh)
+            self.loop.clock = self.clock
+            self.loop.start(self.interval, now=True)
+
+    def stop(self):
+        if self.loop and self.loop.running:
+            self.loop.stop()
+
+    @defer.inlineCallbacks
+    def refresh(self):
+        try:
+            names = yield self.fetch()
+        except Exception, e:
+            self.log.warn(
+                'Error refreshing volume catalog. \"{e}\"', e=e)
+            return
+
+        now = self.clock.seconds()
+        self.volumes = dict((name, now) for name in names)
+
+    def add(self, name):
+        self.volumes[name] = self.clock.seconds()
+
+    def remove(self, name):
+        self.volumes.pop(name, None)
+
+    def _valid(self, seen):
+        return (self.clock.seconds() - seen) < self.ttl
+
+    def __contains__(self, name):
+        seen = self.volumes.get(name)
+        return (seen is not None) and self._valid(seen)
+
+    def names(self):
+        return [n for n, seen in self.volumes.items() if self._valid(seen)]
+
+
+class CreateCache(object):
+    """Volumes this host has successfully created recently
+
+    Docker calls Create before every use of a volume, so repeat Creates
+    with the same options are answered from here for `ttl` seconds instead
+    of sending xylem another job. A `ttl` of 0 disables the cache.
+    """
+    def __init__(self, ttl=300, clock=reactor):
+        self.ttl = ttl
+        self.clock = clock
+        # volume name -> (options, time created)
+        self.volumes = {}
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.volumes)
+
+    def hit(self, name, options):
+        """ Whether `name` was created with `options` within the TTL, the
+        result is counted as a hit or a miss
+        """
+        entry = self.volumes.get(name)
+        if entry is not None and (
+                self.clock.seconds() - entry[1] >= self.ttl):
+            del self.volumes[name]
+            entry = None
+
+        if entry is not None and entry[0] == options:
+            self.hits += 1
+            CREATE_CACHE.inc(result='hit')
+            return True
+
+        self.misses += 1
+        CREATE_CACHE.inc(result='miss')
+        return False
+
+    def add(self, name, options):
+        if self.ttl:
+            self.volumes[name] = (options, self.clock.seconds())
+
+    def remove(self, name):
+        self.volumes.pop(name, None)
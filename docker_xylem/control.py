@@ -0,0 +1,142 @@
+"""
+Control socket for maintenance of the host the plugin runs on.
+
+Serves JSON over HTTP on a UNIX socket, used by scripts/docker-xylem-ctl:
+
+    GET  /status   current or last bulk operation
+    POST /drain    unmount every volume, {"concurrency": N} is optional
+    POST /restore  remount the volumes the last drain unmounted
+    POST /profile  profile the plugin, {"seconds": N} is optional
+"""
+
+import json
+
+from twisted.internet import defer, reactor
+from twisted.python import failure
+from twisted.web import resource, server
+
+from docker_xylem.compat import Logger
+
+
+class Busy(Exception):
+    """
+    Raised when a bulk operation is started while another is running.
+    """
+
+
+class BulkOperation(object):
+    """ Progress of a drain or restore over `names`
+    """
+    def __init__(self, kind, names, clock=reactor):
+        self.log = Logger()
+        self.kind = kind
+        self.total = len(names)
+        self.clock = clock
+        self.started = clock.seconds()
+        self.finished = None
+        self.done = []
+        self.failed = {}
+
+    @property
+    def running(self):
+        return self.finished is None
+
+    def record(self, name, err=None):
+        if err:
+            self.failed[name] = err
+        else:
+            self.done.append(name)
+        self.log.info(
+            '{kind}: {count} of {total} volumes finished, {failed} failed',
+            kind=self.kind, count=len(self.done) + len(self.failed),
+            total=self.total, failed=len(self.failed)
+        )
+
+    def finish(self):
+        self.finished = self.clock.seconds()
+        return self.to_dict()
+
+    def to_dict(self):
+        end = self.finished or self.clock.seconds()
+        return {
+            'operation': self.kind,
+            'running': self.running,
+            'total': self.total,
+            'done': len(self.done),
+            'failed': self.failed,
+            'seconds': end - self.started,
+        }
+
+
+class ControlResource(resource.Resource):
+    isLeaf = True
+
+    def __init__(self, docker):
+        resource.Resource.__init__(self)
+        self.docker = docker
+
+    def _json(self, request, code, data):
+        request.setResponseCode(code)
+        request.setHeader('Content-Type', 'application/json')
+        return json.dumps(data)
+
+    def render_GET(self, request):
+        if request.path != '/status':
+            return self._json(request, 404, {'error': 'Not found'})
+        return self._json(request, 200, self.docker.maintenance_status())
+
+    def render_POST(self, request):
+        try:
+            args = json.loads(request.content.read() or '{}')
+        except ValueError:
+            return self._json(request, 400, {'error': 'Invalid JSON'})
+
+        if request.path == '/profile':
+            d = self.docker.profiler.run(args.get('seconds'))
+
+            def finished(result):
+                if isinstance(result, failure.Failure):
+                    body = self._json(request, 409, {
+                        'error': str(result.value)})
+                else:
+                    body = self._json(request, 200, {'path': result})
+                request.write(body)
+                request.finish()
+
+            d.addBoth(finished)
+            return server.NOT_DONE_YET
+
+        operations = {
+            '/drain': self.docker.drain,
+            '/restore': self.docker.restore,
+        }
+        if request.path not in operations:
+            return self._json(request, 404, {'error': 'Not found'})
+
+        try:
+            # Keeps running after the reply, progress is polled from /status
+            operations[request.path](args.get('concurrency'))
+        except Busy, e:
+            return self._json(request, 409, {'error': str(e)})
+        return self._json(request, 202, self.docker.maintenance_status())
+
+
+def run_bulk(operation, f, items, concurrency):
+    """ Call `f` with each of `items` with at most `concurrency` running at
+    once, recording each outcome in `operation`
+    """
+    semaphore = defer.DeferredSemaphore(concurrency)
+
+    def one(item):
+        d = semaphore.run(f, *item)
+
+        def outcome(result):
+            if isinstance(result, failure.Failure):
+                operation.record(item[0], str(result.value))
+            else:
+                operation.record(item[0], result.get('Err'))
+
+        return d.addBoth(outcome)
+
+    return defer.DeferredList([one(item) for item in items]).addCallback(
+        lambda _: operation.finish())
@@ -0,0 +1,157 @@
+"""
+Tools for finding what holds up the reactor in a running plugin.
+"""
+
+import os
+import sys
+import time
+import signal
+import cProfile
+import threading
+import traceback
+
+from twisted.internet import defer, reactor, task, threads
+
+from docker_xylem.compat import Logger
+from docker_xylem.metrics import REGISTRY
+
+REACTOR_LAG = REGISTRY.histogram(
+    'docker_xylem_reactor_lag_seconds',
+    'How late reactor ticks ran', (),
+    buckets=(0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5))
+
+
+class StallMonitor(object):
+    """Measures how late the reactor runs a call scheduled every `interval`
+    seconds
+
+    A watchdog thread logs the reactor thread's stack once the reactor has
+    not ticked for `threshold` seconds, so the code holding it up is seen
+    while it is still running.
+    """
+    def __init__(self, threshold=0.5, interval=0.1, clock=reactor,
+                 now=time.time):
+        self.log = Logger()
+        self.threshold = threshold
+        self.interval = interval
+        self.clock = clock
+        self.now = now
+        self.last_tick = None
+        self.reported = False
+        self.thread_id = None
+        self.loop = None
+        self.stopped = threading.Event()
+
+    def start(self):
+        if not self.threshold:
+            return
+        self.thread_id = threading.current_thread().ident
+        self.last_tick = self.now()
+        self.loop = task.LoopingCall(self.tick)
+        self.loop.clock = self.clock
+        self.loop.start(self.interval, now=False)
+
+        watchdog = threading.Thread(target=self._watch)
+        watchdog.daemon = True
+        watchdog.start()
+
+    def stop(self):
+        self.stopped.set()
+        if self.loop and self.loop.running:
+            self.loop.stop()
+
+    def tick(self):
+        now = self.now()
+        lag = max(now - self.last_tick - self.interval, 0)
+        REACTOR_LAG.observe(lag)
+        if lag >= self.threshold:
+            self.log.warn('Reactor stalled for {lag:.3f}s', lag=lag)
+        self.last_tick = now
+        self.reported = False
+        return lag
+
+    def check(self):
+        """ Returns the reactor thread's stack if it is stalled and has not
+        been reported yet
+        """
+        stalled = self.now() - self.last_tick - self.interval
+        if self.reported or stalled < self.threshold:
+            return None
+
+        self.reported = True
+        frame = sys._current_frames().get(self.thread_id)
+        if frame is None:
+            return None
+        return ''.join(traceback.format_stack(frame))
+
+    def _watch(self):
+        while not self.stopped.wait(self.interval):
+            stack = self.check()
+            if stack:
+                self.log.error(
+                    'Reactor stalled for over {threshold}s in:\n{stack}',
+                    threshold=self.threshold, stack=stack)
+
+
+class Profiler(object):
+    """Profiles the reactor thread for a while and writes the stats to
+    `directory`, where they can be read with the pstats module
+
+    Sending the plugin `signum` starts a profile of `seconds` seconds. The
+    stats are written from a thread, so a slow disk does not stall the
+    reactor.
+    """
+    def __init__(self, directory, seconds=30, signum=signal.SIGUSR2,
+                 clock=reactor):
+        self.log = Logger()
+        self.directory = directory
+        self.seconds = seconds
+        self.signum = signum
+        self.clock = clock
+        self.profile = None
+        self.previous_handler = None
+
+    def start(self):
+        if self.signum:
+            self.previous_handler = signal.signal(self.signum, self._signal)
+
+    def stop(self):
+        if self.signum and self.previous_handler is not None:
+            signal.signal(self.signum, self.previous_handler)
+            self.previous_handler = None
+
+    def _signal(self, signum, frame):
+        reactor.callFromThread(self.run)
+
+    def run(self, seconds=None):
+        """ Profile for `seconds`, returns a Deferred firing with the path
+        of the stats file
+        """
+        if self.profile is not None:
+            return defer.fail(Exception('A profile is already running'))
+
+        seconds = seconds or self.seconds
+        path = os.path.join(self.directory, 'docker-xylem-%s.prof' % (
+            time.strftime('%Y%m%d-%H%M%S', time.gmtime(self.clock.seconds()))))
+        self.log.info('Profiling for {seconds}s to \"{path}\"',
+                      seconds=seconds, path=path)
+
+        self.profile = cProfile.Profile()
+        self.profile.enable()
+        return task.deferLater(self.clock, seconds, self._finish, path)
+
+    def _finish(self, path):
+        profile, self.profile = self.profile, None
+        profile.disable()
+
+        def written(_):
+            self.log.info('Profile written to \"{path}\"', path=path)
+            return path
+
+        return threads.deferToThread(
+            self._write, profile, path).addCallback(written)
+
+    def _write(self, profile, path):
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        profile.dump_stats(path)
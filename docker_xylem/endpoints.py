@@ -0,0 +1,262 @@
+import collections
+
+from twisted.internet import defer, reactor, task
+
+from docker_xylem.compat import Logger
+
+
+class CircuitOpen(Exception):
+    """
+    Raised instead of calling xylem while every endpoint's circuit is open.
+    """
+
+
+def parse_hosts(hosts, port):
+    """parse_hosts
+    Parses the host config option into a list of (host, port) tuples
+
+    :param hosts: A host name or list of host names, each optionally
+        followed by :port. IPv6 addresses must be in brackets, as in
+        [2001:db8::1]:7701
+    :param port: Port used when a host does not specify one
+    :type port: int.
+    :raises: ValueError if a host is not in one of these forms
+    """
+    if isinstance(hosts, basestring):
+        hosts = [hosts]
+
+    parsed = []
+    for host in hosts:
+        if host.startswith('['):
+            address, bracket, rest = host[1:].partition(']')
+            if not bracket or (rest and not rest.startswith(':')):
+                raise ValueError('Invalid xylem host %s' % host)
+            host, host_port = address, rest[1:]
+        elif host.count(':') > 1:
+            raise ValueError(
+                'IPv6 xylem host %s must be in brackets, as in [%s]:%s' % (
+                    host, host, port))
+        else:
+            host, _, host_port = host.partition(':')
+
+        parsed.append((host, int(host_port) if host_port else port))
+    return parsed
+
+
+class CircuitBreaker(object):
+    """Stops requests to an endpoint which keeps failing
+
+    The circuit opens after `threshold` consecutive failures. While open no
+    requests are allowed until `reset_timeout` seconds pass, after which it
+    is half open and lets `trials` requests through at a time. A success
+    closes the circuit and a failure opens it again.
+    """
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, threshold=5, reset_timeout=30, trials=1,
+                 clock=reactor):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.trials = trials
+        self.clock = clock
+        self._state = self.CLOSED
+        self.failures = 0
+        self.opened = None
+        self.running = 0
+
+    @property
+    def state(self):
+        if (self._state == self.OPEN) and (
+                self.clock.seconds() >= self.opened + self.reset_timeout):
+            self._state = self.HALF_OPEN
+            self.running = 0
+        return self._state
+
+    def ready(self):
+        """ Whether a request may be made now
+        """
+        state = self.state
+        if state == self.HALF_OPEN:
+            return self.running < self.trials
+        return state == self.CLOSED
+
+    def begin(self):
+        if self.state == self.HALF_OPEN:
+            self.running += 1
+
+    def success(self):
+        self._state = self.CLOSED
+        self.failures = 0
+
+    def failure(self):
+        self.failures += 1
+        if (self.state == self.HALF_OPEN) or (
+                self.failures >= self.threshold):
+            self._state = self.OPEN
+            self.opened = self.clock.seconds()
+
+
+class AdaptiveTimeout(object):
+    """Derives request timeouts from the latencies seen recently
+
+    The timeout for a kind of request is `factor` times the `percentile`
+    of its last `window` latencies, kept between `minimum` and the
+    maximum the caller allows. The maximum is used until `min_samples`
+    latencies have been seen.
+    """
+    def __init__(self, percentile=0.99, factor=2, minimum=1, window=200,
+                 min_samples=20):
+        self.percentile = percentile
+        self.factor = factor
+        self.minimum = minimum
+        self.window = window
+        self.min_samples = min_samples
+        self.latencies = {}
+
+    def observe(self, kind, latency):
+        if kind not in self.latencies:
+            self.latencies[kind] = collections.deque(maxlen=self.window)
+        self.latencies[kind].append(latency)
+
+    def timeout(self, kind, maximum):
+        latencies = self.latencies.get(kind)
+        if not latencies or len(latencies) < self.min_samples:
+            return maximum
+
+        ordered = sorted(latencies)
+        index = min(int(len(ordered) * self.percentile), len(ordered) - 1)
+        return min(max(ordered[index] * self.factor, self.minimum), maximum)
+
+
+class Endpoint(object):
+    def __init__(self, host, port, breaker, max_requests=None):
+        self.host = host
+        self.port = port
+        self.breaker = breaker
+        self.healthy = True
+        # Exponentially weighted moving average of request latency
+        self.latency = None
+        if max_requests:
+            self.slots = defer.DeferredSemaphore(max_requests)
+        else:
+            self.slots = None
+
+    def url(self, path):
+        if ':' in self.host:
+            return 'http://[%s]:%s%s' % (self.host, self.port, path)
+        return 'http://%s:%s%s' % (self.host, self.port, path)
+
+    def limit(self, f, *args, **kw):
+        """ Call `f` once fewer than `max_requests` requests made through
+        this method are running
+        """
+        if self.slots is None:
+            return defer.maybeDeferred(f, *args, **kw)
+        return self.slots.run(f, *args, **kw)
+
+    def __repr__(self):
+        return '<Endpoint %s:%s>' % (self.host, self.port)
+
+
+class EndpointSet(object):
+    """Picks the healthiest of several xylem endpoints
+
+    Every endpoint is probed in the background every `interval` seconds.
+    Requests go to the healthy endpoint with the lowest latency average,
+    or the lowest latency endpoint overall if none are healthy. Endpoints
+    whose circuit breaker is open are skipped, and `choose` raises
+    `CircuitOpen` if that leaves none. Each endpoint allows at most
+    `max_requests` requests at once through `Endpoint.limit`.
+    """
+    def __init__(self, endpoints, probe, interval=10, alpha=0.3,
+                 breaker_threshold=5, breaker_reset=30, max_requests=None,
+                 clock=reactor):
+        self.log = Logger()
+        self.endpoints = [
+            Endpoint(host, port, CircuitBreaker(
+                breaker_threshold, breaker_reset, clock=clock),
+                max_requests=max_requests)
+            for host, port in endpoints
+        ]
+        self.probe = probe
+        self.interval = interval
+        self.alpha = alpha
+        self.clock = clock
+        self.loop = None
+
+    def start(self):
+        if self.interval and (len(self.endpoints) > 1):
+            self.loop = task.LoopingCall(self.probe_all)
+            self.loop.clock = self.clock
+            self.loop.start(self.interval, now=True)
+
+    def stop(self):
+        if self.loop and self.loop.running:
+            self.loop.stop()
+
+    def choose(self):
+        ready = [e for e in self.endpoints if e.breaker.ready()]
+        if not ready:
+            raise CircuitOpen('Circuit open for every xylem endpoint')
+
+        candidates = [e for e in ready if e.healthy]
+        if not candidates:
+            candidates = ready
+
+        # Endpoints without a latency yet are tried first
+        return min(candidates, key=lambda e: e.latency or 0)
+
+    def record(self, endpoint, latency=None):
+        """ Record a successful request to `endpoint` taking `latency`
+        seconds, or a failed request if `latency` is None
+        """
+        breaker = endpoint.breaker
+        if latency is None:
+            if endpoint.healthy:
+                self.log.warn('Xylem {endpoint} is unhealthy',
+                              endpoint=endpoint)
+            endpoint.healthy = False
+
+            was_open = breaker.state == breaker.OPEN
+            breaker.failure()
+            if not was_open and breaker.state == breaker.OPEN:
+                self.log.warn(
+                    'Circuit opened for xylem {endpoint} for {seconds}s',
+                    endpoint=endpoint, seconds=breaker.reset_timeout)
+            return
+
+        if not endpoint.healthy:
+            self.log.info('Xylem {endpoint} is healthy', endpoint=endpoint)
+        endpoint.healthy = True
+
+        if breaker.state != breaker.CLOSED:
+            self.log.info('Circuit closed for xylem {endpoint}',
+                          endpoint=endpoint)
+        breaker.success()
+
+        if endpoint.latency is None:
+            endpoint.latency = latency
+        else:
+            endpoint.latency = (
+                self.alpha * latency + (1 - self.alpha) * endpoint.latency)
+
+    @defer.inlineCallbacks
+    def call(self, f, endpoint):
+        """ Call `f` with `endpoint` and record how it went
+        """
+        start = self.clock.seconds()
+        endpoint.breaker.begin()
+        try:
+            result = yield defer.maybeDeferred(f, endpoint)
+        except Exception:
+            self.record(endpoint)
+            raise
+        self.record(endpoint, self.clock.seconds() - start)
+        defer.returnValue(result)
+
+    def probe_all(self):
+        return defer.DeferredList([
+            self.call(self.probe, endpoint) for endpoint in self.endpoints
+        ], consumeErrors=True)
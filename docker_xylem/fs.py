@@ -0,0 +1,182 @@
+"""
+Filesystem calls run off the reactor thread.
+
+Any call on a path under a hung gluster mount can block forever, so the
+plugin never makes one on the reactor thread.
+"""
+
+import os
+import errno
+import Queue
+import threading
+
+from twisted.internet import defer, reactor
+from twisted.python import failure
+
+from docker_xylem.utils import Timeout
+from docker_xylem.metrics import REGISTRY
+
+FS_TIMEOUTS = REGISTRY.counter(
+    'docker_xylem_fs_timeouts_total',
+    'Filesystem calls which missed their deadline', ['call'])
+
+
+class _Call(object):
+    def __init__(self, f, args, key):
+        self.f = f
+        self.args = args
+        self.key = key
+        self.deferred = defer.Deferred()
+        self.timer = None
+        self.started = False
+        self.finished = False
+        self.abandoned = False
+
+
+class FilesystemExecutor(object):
+    """Runs blocking filesystem calls on up to `max_threads` threads
+
+    Each call fails with `Timeout` if it has not returned within `timeout`
+    seconds. A thread stuck in a call which timed out is abandoned: it no
+    longer counts towards `max_threads`, so another is started in its
+    place, and it exits once the call returns. While a call for the same
+    key is hung, or `max_hung` threads are, new calls fail at once rather
+    than tying up more threads. Threads are daemons so a hung call never
+    holds up shutdown.
+    """
+    def __init__(self, max_threads=4, timeout=10, max_hung=32,
+                 clock=reactor):
+        self.max_threads = max_threads
+        self.timeout = timeout
+        self.max_hung = max_hung
+        self.clock = clock
+        self.queue = Queue.Queue()
+        self.lock = threading.Lock()
+        self.threads = 0
+        self.idle = 0
+        # key -> number of abandoned threads still stuck in a call for it
+        self.hung = {}
+
+    @property
+    def hung_threads(self):
+        return sum(self.hung.values())
+
+    def _worker(self):
+        while True:
+            with self.lock:
+                self.idle += 1
+            call = self.queue.get()
+            with self.lock:
+                self.idle -= 1
+                if call is None:
+                    self.threads -= 1
+                    return
+                if call.finished:
+                    # Timed out before it was started
+                    continue
+                call.started = True
+
+            try:
+                result = call.f(*call.args)
+            except Exception:
+                result = failure.Failure()
+
+            with self.lock:
+                call.finished = True
+                abandoned = call.abandoned
+                if abandoned:
+                    self.hung[call.key] -= 1
+                    if not self.hung[call.key]:
+                        del self.hung[call.key]
+
+            if abandoned:
+                # A replacement thread took our place
+                return
+            reactor.callFromThread(self._deliver, call, result)
+
+    def _spawn(self):
+        with self.lock:
+            if self.idle or (self.threads >= self.max_threads):
+                return
+            self.threads += 1
+        thread = threading.Thread(target=self._worker)
+        thread.daemon = True
+        thread.start()
+
+    def _deliver(self, call, result):
+        if call.deferred.called:
+            return
+        call.timer.cancel()
+        if isinstance(result, failure.Failure):
+            call.deferred.errback(result)
+        else:
+            call.deferred.callback(result)
+
+    def _expire(self, call, name, timeout):
+        with self.lock:
+            if call.started and not call.finished:
+                call.abandoned = True
+                self.threads -= 1
+                self.hung[call.key] = self.hung.get(call.key, 0) + 1
+            call.finished = True
+
+        FS_TIMEOUTS.inc(call=name)
+        call.deferred.errback(Timeout(
+            "%s(%s) took longer than %s seconds" % (
+                name, ', '.join(map(repr, call.args)), timeout)))
+        if not self.queue.empty():
+            self._spawn()
+
+    def run(self, f, *args, **kw):
+        """ Call `f` in a thread, returns a Deferred firing with its result
+
+        :param timeout: Seconds to wait for the call, overriding `timeout`
+        :param key: Identifies calls which hang together, by default `f`
+            and `args`
+        """
+        timeout = kw.get('timeout', self.timeout)
+        key = kw.get('key', (f, args))
+        name = getattr(f, '__name__', repr(f)).lstrip('_')
+
+        with self.lock:
+            if key in self.hung:
+                reason = 'an earlier call is still hung'
+            elif self.hung_threads >= self.max_hung:
+                reason = '%s calls are hung' % self.hung_threads
+            else:
+                reason = None
+        if reason:
+            FS_TIMEOUTS.inc(call=name)
+            return defer.fail(Timeout("%s(%s) not attempted, %s" % (
+                name, ', '.join(map(repr, args)), reason)))
+
+        call = _Call(f, args, key)
+        call.timer = self.clock.callLater(
+            timeout, self._expire, call, name, timeout)
+        self.queue.put(call)
+        self._spawn()
+        return call.deferred
+
+    def makedirs(self, path):
+        """ Create `path` and its parents, if it does not already exist
+        """
+        return self.run(_makedirs, path)
+
+    def stat(self, path):
+        return self.run(os.stat, path)
+
+    def stop(self):
+        """ Let idle threads exit, without waiting for blocked ones
+        """
+        with self.lock:
+            threads = self.threads
+        for i in range(threads):
+            self.queue.put(None)
+
+
+def _makedirs(path):
+    try:
+        os.makedirs(path)
+    except OSError, e:
+        if e.errno != errno.EEXIST:
+            raise
@@ -0,0 +1,208 @@
+import os
+import json
+import Queue
+import threading
+
+from docker_xylem.compat import Logger
+
+
+class StateJournal(object):
+    """Append-only journal of the volumes mounted by the plugin
+
+    Every change to a volume appends one JSON line holding its full state,
+    so replaying the file and keeping the last line for each volume
+    rebuilds the state. The journal is compacted to one line per mounted
+    volume once it holds too many superseded lines.
+
+    Writes are made by a background thread, so a slow or hung filesystem
+    under the journal never blocks the reactor. `close` waits up to
+    `close_timeout` seconds for them to finish.
+    """
+    def __init__(self, path, compact_after=1000, close_timeout=5):
+        self.log = Logger()
+        self.path = path
+        self.compact_after = compact_after
+        self.close_timeout = close_timeout
+        self.state = {}
+        self.records = 0
+        self.fd = None
+        self.queue = Queue.Queue()
+        self.thread = None
+
+    def load(self):
+        """ Replay the journal
+
+        :returns: dict of volume name to a (path, refs) tuple
+        """
+        self.state = {}
+        self.records = 0
+
+        try:
+            fd = open(self.path, 'r')
+        except IOError:
+            return {}
+
+        with fd:
+            for line in fd:
+                try:
+                    record = json.loads(line)
+                    name = record['name']
+                except (ValueError, KeyError, TypeError):
+                    # A torn write from a crash, ignore it
+                    self.log.warn(
+                        'Ignoring corrupt journal line in {path}',
+                        path=self.path
+                    )
+                    continue
+
+                self.records += 1
+                value = self._decode(record)
+                if value:
+                    self.state[name] = value
+                else:
+                    self.state.pop(name, None)
+
+        return dict(self.state)
+
+    def _decode(self, record):
+        if record.get('path'):
+            return (record['path'], record.get('refs', []))
+        return None
+
+    def _line(self, name, value):
+        path, refs = value or (None, [])
+        return json.dumps({
+            'name': name,
+            'path': path,
+            'refs': sorted(refs or [])
+        }) + '\n'
+
+    def _makedirs(self):
+        parent = os.path.dirname(self.path)
+        if parent and not os.path.isdir(parent):
+            os.makedirs(parent)
+
+    def _open(self):
+        if self.fd is None:
+            self._makedirs()
+            self.fd = open(self.path, 'a')
+        return self.fd
+
+    def _submit(self, f, *args):
+        if self.thread is None or not self.thread.is_alive():
+            self.thread = threading.Thread(target=self._writer)
+            self.thread.daemon = True
+            self.thread.start()
+        self.queue.put((f, args))
+
+    def _writer(self):
+        while True:
+            work = self.queue.get()
+            try:
+                if work is None:
+                    self._close_fd()
+                    return
+                f, args = work
+                f(*args)
+            finally:
+                self.queue.task_done()
+
+    def record(self, name, path, refs=()):
+        """ Record the state of a volume, a `path` of None records that the
+        volume is no longer mounted
+        """
+        if path:
+            self._update(name, (path, sorted(refs or [])))
+        else:
+            self._update(name, None)
+
+    def _update(self, name, value):
+        if value:
+            self.state[name] = value
+        else:
+            self.state.pop(name, None)
+
+        self._submit(self._write, self._line(name, value))
+        self.records += 1
+
+        if self.records > max(self.compact_after, 4 * len(self.state)):
+            self.compact()
+
+    def _write(self, line):
+        try:
+            fd = self._open()
+            fd.write(line)
+            fd.flush()
+        except (IOError, OSError), e:
+            self.log.error(
+                'Error writing state journal {path}. \"{e}\"',
+                path=self.path, e=e
+            )
+
+    def compact(self, state=None):
+        """ Rewrite the journal with one line per mounted volume
+        """
+        if state is not None:
+            self.state = dict(state)
+
+        self._submit(self._compact, sorted(self.state.items()))
+        self.records = len(self.state)
+
+    def _compact(self, state):
+        self._close_fd()
+        tmp = self.path + '.tmp'
+        try:
+            self._makedirs()
+            with open(tmp, 'w') as fd:
+                for name, value in state:
+                    fd.write(self._line(name, value))
+                fd.flush()
+                os.fsync(fd.fileno())
+            os.rename(tmp, self.path)
+        except (IOError, OSError), e:
+            self.log.error(
+                'Error compacting state journal {path}. \"{e}\"',
+                path=self.path, e=e
+            )
+
+    def _close_fd(self):
+        if self.fd is not None:
+            self.fd.close()
+            self.fd = None
+
+    def flush(self):
+        """ Block until every queued write has been made
+        """
+        self.queue.join()
+
+    def close(self):
+        """ Finish the queued writes, waiting up to `close_timeout` seconds
+        """
+        if self.thread is not None and self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join(self.close_timeout)
+            if self.thread.is_alive():
+                self.log.error(
+                    'Gave up waiting for writes to state journal {path}',
+                    path=self.path
+                )
+            self.thread = None
+
+
+class OptionsJournal(StateJournal):
+    """Journal of the options each volume was created with
+
+    Uses the same format and compaction as `StateJournal`, with one line
+    per volume holding its options.
+    """
+    def _decode(self, record):
+        return record.get('opts') or None
+
+    def _line(self, name, opts):
+        return json.dumps({'name': name, 'opts': opts or {}}) + '\n'
+
+    def record(self, name, opts):
+        """ Record the options of a volume, empty `opts` or None records
+        that the volume has none
+        """
+        self._update(name, dict(opts or {}))
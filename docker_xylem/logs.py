@@ -0,0 +1,161 @@
+"""
+Request log filtering and an off-reactor log writer.
+
+To write the twistd log from a background thread start the plugin with::
+
+    twistd --logger=docker_xylem.logs.logger docker_xylem
+
+which writes to the file named by $DOCKER_XYLEM_LOGFILE.
+"""
+
+import os
+import json
+import time
+import Queue
+import threading
+
+from twisted.internet import reactor
+from twisted.python import log, logfile
+from twisted.python.util import untilConcludes
+
+LEVELS = ('debug', 'info', 'warn', 'error', 'critical')
+
+# Endpoints Docker polls, which are sampled rather than always logged
+SAMPLED_ENDPOINTS = (
+    '/VolumeDriver.Path',
+    '/VolumeDriver.Get',
+    '/VolumeDriver.List',
+    '/VolumeDriver.Capabilities',
+)
+
+
+class LazyJSON(object):
+    """ Defers serialising `data` until the log line is formatted
+    """
+    def __init__(self, data):
+        self.data = data
+
+    def __str__(self):
+        return json.dumps(self.data)
+
+    def __format__(self, spec):
+        return format(str(self), spec)
+
+
+def _level_index(level):
+    if level not in LEVELS:
+        raise ValueError('Unknown log level %r, must be one of %s' % (
+            level, ', '.join(LEVELS)))
+    return LEVELS.index(level)
+
+
+class RequestLogPolicy(object):
+    """Decides which Docker calls to log and at which level
+
+    :param level: Level calls are logged at unless `levels` overrides it
+    :param levels: dict of endpoint to level
+    :param min_level: Calls below this level are not logged at all
+    :param sample_rate: Fraction of calls to sampled endpoints to log
+    :raises: ValueError if any level is unknown
+    """
+    def __init__(self, level='info', levels={}, min_level='debug',
+                 sample_rate=1.0, sampled=SAMPLED_ENDPOINTS):
+        min_index = _level_index(min_level)
+
+        def logged(level):
+            # Resolved once here rather than for every call
+            return level if _level_index(level) >= min_index else None
+
+        self.level = logged(level)
+        self.levels = dict(
+            ('/' + k.lstrip('/'), logged(v)) for k, v in levels.items())
+        if sample_rate > 0:
+            self.sample_every = max(int(round(1 / float(sample_rate))), 1)
+        else:
+            self.sample_every = None
+        self.sampled = set(sampled)
+        self.counts = {}
+
+    def level_for(self, endpoint):
+        """ Returns the level to log a call to `endpoint` at, or None if it
+        should not be logged
+        """
+        level = self.levels.get(endpoint, self.level)
+        if level is None:
+            return None
+
+        if endpoint in self.sampled:
+            if self.sample_every is None:
+                return None
+            count = self.counts.get(endpoint, 0)
+            self.counts[endpoint] = count + 1
+            if count % self.sample_every:
+                return None
+
+        return level
+
+
+class BufferedLogWriter(object):
+    """Log observer which formats events on the reactor thread and writes
+    them to `logfile` from a background thread
+
+    Lines are dropped, and counted in `dropped`, if more than `max_buffer`
+    are waiting to be written.
+    """
+    def __init__(self, logfile, max_buffer=10000):
+        self.logfile = logfile
+        self.queue = Queue.Queue(max_buffer)
+        self.dropped = 0
+        self.thread = threading.Thread(target=self._write)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def __call__(self, eventDict):
+        text = log.textFromEventDict(eventDict)
+        if text is None:
+            return
+
+        self.write('%s [%s] %s\n' % (
+            time.strftime(
+                '%Y-%m-%d %H:%M:%S%z', time.localtime(eventDict['time'])),
+            eventDict['system'], text.replace('\n', '\n\t')))
+
+    def write(self, line):
+        """ Queue `line` to be written
+        """
+        try:
+            self.queue.put_nowait(line)
+        except Queue.Full:
+            self.dropped += 1
+
+    def _write(self):
+        while True:
+            lines = [self.queue.get()]
+            try:
+                while len(lines) < 1000:
+                    lines.append(self.queue.get_nowait())
+            except Queue.Empty:
+                pass
+
+            done = None in lines
+            lines = [line for line in lines if line is not None]
+            if lines:
+                untilConcludes(self.logfile.write, ''.join(lines))
+                untilConcludes(self.logfile.flush)
+            if done:
+                return
+
+    def stop(self):
+        """ Write any buffered lines and stop the writer thread
+        """
+        self.queue.put(None)
+        self.thread.join()
+
+
+def logger():
+    """ Log observer factory for twistd --logger
+    """
+    writer = BufferedLogWriter(logfile.LogFile.fromFullPath(
+        os.environ.get('DOCKER_XYLEM_LOGFILE', '/var/log/docker-xylem.log')))
+    reactor.addSystemEventTrigger('after', 'shutdown', writer.stop)
+    return writer
@@ -0,0 +1,159 @@
+"""
+Minimal metrics registry which renders the Prometheus text exposition
+format, so the plugin does not need an extra dependency to be scraped.
+"""
+
+from twisted.web import resource
+
+INF = float('inf')
+
+DEFAULT_BUCKETS = (
+    .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60, INF)
+
+
+def format_value(value):
+    if value == INF:
+        return '+Inf'
+    return repr(float(value))
+
+
+def format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{%s}' % ','.join(
+        '%s="%s"' % (k, str(v).replace('\\', r'\\').replace(
+            '"', r'\"').replace('\n', r'\n'))
+        for k, v in pairs)
+
+
+class Metric(object):
+    type = None
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.values = {}
+
+    def _key(self, labels):
+        return tuple(labels.get(name, '') for name in self.labels)
+
+    def samples(self):
+        raise NotImplementedError()
+
+    def render(self):
+        lines = [
+            '# HELP %s %s' % (self.name, self.help),
+            '# TYPE %s %s' % (self.name, self.type),
+        ]
+        for suffix, labels, extra, value in self.samples():
+            lines.append('%s%s%s %s' % (
+                self.name, suffix, format_labels(self.labels, labels, extra),
+                format_value(value)))
+        return '\n'.join(lines)
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def get(self, **labels):
+        return self.values.get(self._key(labels), 0)
+
+    def samples(self):
+        for key, value in sorted(self.values.items()):
+            yield '', key, (), value
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        Metric.__init__(self, name, help, labels)
+        self.buckets = tuple(sorted(buckets))
+        if self.buckets[-1] != INF:
+            self.buckets += (INF,)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        counts, total = self.values.get(key, ([0] * len(self.buckets), 0))
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                counts[i] += 1
+        self.values[key] = (counts, total + value)
+
+    def count(self, **labels):
+        counts, total = self.values.get(
+            self._key(labels), ([0] * len(self.buckets), 0))
+        return counts[-1]
+
+    def samples(self):
+        for key, (counts, total) in sorted(self.values.items()):
+            for bound, count in zip(self.buckets, counts):
+                yield '_bucket', key, [('le', format_value(bound))], count
+            yield '_sum', key, (), total
+            yield '_count', key, (), counts[-1]
+
+
+class Gauge(Metric):
+    """ Gauge whose value is read from a callable when rendered
+    """
+    type = 'gauge'
+
+    def __init__(self, name, help, func):
+        Metric.__init__(self, name, help)
+        self.func = func
+
+    def get(self):
+        return self.func()
+
+    def samples(self):
+        yield '', (), (), self.func()
+
+
+class Registry(object):
+    def __init__(self):
+        self.metrics = {}
+
+    def _get(self, cls, name, *args, **kw):
+        if not isinstance(self.metrics.get(name), cls):
+            self.metrics[name] = cls(name, *args, **kw)
+        return self.metrics[name]
+
+    def counter(self, name, help, labels=()):
+        return self._get(Counter, name, help, labels)
+
+    def histogram(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        return self._get(Histogram, name, help, labels, buckets)
+
+    def gauge(self, name, help, func):
+        # Gauges read the state of a single object, so always replace them
+        self.metrics[name] = Gauge(name, help, func)
+        return self.metrics[name]
+
+    def render(self):
+        return '\n'.join(
+            self.metrics[name].render() for name in sorted(self.metrics)
+        ) + '\n'
+
+
+REGISTRY = Registry()
+
+
+class MetricsResource(resource.Resource):
+    """ Serves a registry for scraping
+    """
+    isLeaf = True
+
+    def __init__(self, registry=REGISTRY):
+        resource.Resource.__init__(self)
+        self.registry = registry
+
+    def render_GET(self, request):
+        request.setHeader(
+            "content-type", "text/plain; version=0.0.4; charset=utf-8")
+        return self.registry.render()
@@ -0,0 +1,125 @@
+"""
+Long lived helper which runs mount and umount on behalf of the plugin.
+
+Forking the small helper is much cheaper than forking the Twisted process
+for every command. Commands arrive on stdin and results are written to
+stdout, each as a netstring holding a JSON object. Only the executables
+named on the command line may be run::
+
+    python -m docker_xylem.mount_helper /bin/mount /bin/umount
+
+This module must not import Twisted, to keep the helper small.
+"""
+
+import os
+import sys
+import json
+import threading
+import subprocess
+
+SCRIPT = os.path.splitext(os.path.abspath(__file__))[0] + '.py'
+
+# Bytes of stdout and stderr returned for each command
+OUTPUT_LIMIT = 65536
+
+
+def read_netstring(stream):
+    """ Read one netstring from `stream`, returns None at end of file
+    """
+    length = ''
+    while True:
+        c = stream.read(1)
+        if not c:
+            return None
+        if c == ':':
+            break
+        if not c.isdigit() or len(length) > 9:
+            raise ValueError('Invalid netstring length')
+        length += c
+
+    data = stream.read(int(length))
+    if stream.read(1) != ',':
+        raise ValueError('Invalid netstring terminator')
+    return data
+
+
+def netstring(data):
+    return '%d:%s,' % (len(data), data)
+
+
+def truncate(data):
+    if len(data) > OUTPUT_LIMIT:
+        half = OUTPUT_LIMIT // 2
+        data = '%s\n[... %s bytes truncated ...]\n%s' % (
+            data[:half], len(data) - OUTPUT_LIMIT, data[-half:])
+    return data.decode('utf-8', 'replace')
+
+
+class Helper(object):
+    def __init__(self, allowed, stdin, stdout):
+        self.allowed = set(allowed)
+        self.stdin = stdin
+        self.stdout = stdout
+        self.lock = threading.Lock()
+        self.threads = []
+
+    def write(self, response):
+        data = netstring(json.dumps(response))
+        with self.lock:
+            self.stdout.write(data)
+            self.stdout.flush()
+
+    def execute(self, command):
+        response = {'id': command.get('id')}
+        try:
+            executable = command['executable']
+            if executable not in self.allowed:
+                raise ValueError('%s may not be run' % executable)
+
+            proc = subprocess.Popen(
+                [executable] + list(command.get('args', [])),
+                stdin=open('/dev/null'), stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE, close_fds=True,
+                env=command.get('env'), cwd=command.get('path'))
+
+            timer = threading.Timer(command.get('timeout', 3600), proc.kill)
+            timer.start()
+            try:
+                out, err = proc.communicate()
+            finally:
+                timer.cancel()
+
+            response['out'] = truncate(out)
+            response['err'] = truncate(err)
+            if proc.returncode < 0:
+                response['signal'] = -proc.returncode
+            else:
+                response['code'] = proc.returncode
+        except Exception, e:
+            response['error'] = str(e)
+
+        self.write(response)
+
+    def serve(self):
+        while True:
+            data = read_netstring(self.stdin)
+            if data is None:
+                break
+
+            t = threading.Thread(target=self.execute, args=(json.loads(data),))
+            t.daemon = True
+            t.start()
+            self.threads.append(t)
+            self.threads = [th for th in self.threads if th.is_alive()]
+
+        # Let running commands finish once the plugin closes our stdin
+        for t in self.threads:
+            t.join()
+
+
+def main(argv):
+    Helper(argv, sys.stdin, sys.stdout).serve()
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,338 @@
+import re
+import errno
+import heapq
+import select
+import itertools
+import collections
+
+from twisted.internet import defer, reactor, task
+from twisted.python import failure
+
+from docker_xylem.compat import Logger
+from docker_xylem.utils import Timeout
+
+# Unmounts are scheduled before mounts so resources are freed first
+PRIORITY_UNMOUNT = 0
+PRIORITY_MOUNT = 1
+
+
+def unescape(field):
+    """ Decode the octal escapes the kernel uses for whitespace and
+    backslashes in mountinfo fields
+    """
+    return re.sub(r'\\([0-7]{3})', lambda m: chr(int(m.group(1), 8)), field)
+
+
+def parse_mountinfo(content):
+    """parse_mountinfo
+    Parses the content of a /proc/<pid>/mountinfo file
+
+    :param content: Content of the mountinfo file
+    :type content: str.
+    :returns: dict of mount point to a (fstype, source) tuple
+    """
+    mounts = {}
+    for line in content.splitlines():
+        fields = line.split()
+        if '-' not in fields:
+            continue
+
+        sep = fields.index('-')
+        if (sep < 5) or (len(fields) < sep + 3):
+            continue
+
+        mounts[unescape(fields[4])] = (
+            fields[sep + 1], unescape(fields[sep + 2]))
+
+    return mounts
+
+
+class MountTable(object):
+    """In-memory index of the kernel mount table
+
+    The mountinfo file is parsed once and then only re-read when the kernel
+    flags a change to the mount table by raising a priority event on it, so
+    looking up the mount state never forks or hits the disk.
+    """
+    def __init__(self, path='/proc/self/mountinfo'):
+        self.log = Logger()
+        self.path = path
+        self.mounts = {}
+        self.stale = True
+        self.poller = None
+        self.fd = None
+
+        if path:
+            try:
+                self.fd = open(path, 'r')
+            except IOError, e:
+                self.log.warn(
+                    'Mount table {path} unavailable: {e}', path=path, e=e)
+            else:
+                self.poller = select.poll()
+                self.poller.register(
+                    self.fd, select.POLLPRI | select.POLLERR)
+
+    @property
+    def available(self):
+        return self.fd is not None
+
+    def invalidate(self):
+        """ Force the mount table to be re-read on the next lookup
+        """
+        self.stale = True
+
+    def refresh(self):
+        """ Re-read the mount table if the kernel reported a change
+        """
+        if not self.available:
+            return
+
+        if self.poller.poll(0):
+            self.stale = True
+
+        if self.stale:
+            self.fd.seek(0)
+            self.mounts = parse_mountinfo(self.fd.read())
+            self.stale = False
+
+    def is_mounted(self, path):
+        """ Returns True if something is mounted on `path`
+        """
+        self.refresh()
+        return path in self.mounts
+
+    def mounted_under(self, root):
+        """ Returns a dict of name to mount point for each mount directly
+        below `root`
+        """
+        self.refresh()
+        root = root.rstrip('/')
+        mounts = {}
+        for mountpoint in self.mounts:
+            parent, name = mountpoint.rsplit('/', 1)
+            if parent == root and name:
+                mounts[name] = mountpoint
+        return mounts
+
+    def close(self):
+        if self.available:
+            self.poller.unregister(self.fd)
+            self.fd.close()
+            self.fd = None
+
+
+class MountScheduler(object):
+    """Bounds the number of concurrent mount and umount processes
+
+    Operations on one volume are run one at a time in the order they
+    arrive, and at most `concurrency` operations run across all volumes.
+    When the limit is reached waiting operations are started in priority
+    order.
+    """
+    def __init__(self, concurrency=8):
+        self.concurrency = concurrency
+        self.running = 0
+        self.waiting = []
+        self.order = itertools.count()
+        # volume name -> [DeferredLock, number of operations using it]
+        self.locks = {}
+
+    @property
+    def depth(self):
+        """ Number of operations waiting to run
+        """
+        locked = sum(len(lock.waiting) for lock, users in self.locks.values())
+        return locked + len(self.waiting)
+
+    def _acquire(self, priority):
+        if self.running < self.concurrency:
+            self.running += 1
+            return defer.succeed(None)
+
+        d = defer.Deferred()
+        heapq.heappush(self.waiting, (priority, next(self.order), d))
+        return d
+
+    def _release(self):
+        if self.waiting:
+            # Hand the slot straight to the next operation
+            priority, order, d = heapq.heappop(self.waiting)
+            d.callback(None)
+        else:
+            self.running -= 1
+
+    @defer.inlineCallbacks
+    def limit(self, priority, f, *args, **kw):
+        """ Call `f` once fewer than `concurrency` operations are running
+        """
+        yield self._acquire(priority)
+        try:
+            result = yield defer.maybeDeferred(f, *args, **kw)
+        finally:
+            self._release()
+        defer.returnValue(result)
+
+    @defer.inlineCallbacks
+    def serialize(self, volume, f, *args, **kw):
+        """ Call `f` once every earlier operation on `volume` has finished
+        """
+        entry = self.locks.setdefault(volume, [defer.DeferredLock(), 0])
+        entry[1] += 1
+        try:
+            result = yield entry[0].run(f, *args, **kw)
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self.locks[volume]
+        defer.returnValue(result)
+
+
+class WarmMounts(object):
+    """Volumes kept mounted for a while after their last user unmounts them
+
+    `expire` is called with the name of a volume once it has been warm for
+    `grace` seconds, or when more than `limit` volumes are warm and it is
+    the least recently used.
+    """
+    def __init__(self, expire, grace=0, limit=16, clock=reactor):
+        self.expire = expire
+        self.grace = grace
+        self.limit = limit
+        self.clock = clock
+        # volume name -> DelayedCall expiring it, oldest first
+        self.timers = collections.OrderedDict()
+
+    def __contains__(self, name):
+        return name in self.timers
+
+    def __len__(self):
+        return len(self.timers)
+
+    def add(self, name):
+        self.take(name)
+        self.timers[name] = self.clock.callLater(
+            self.grace, self._expire, name)
+
+        while len(self.timers) > self.limit:
+            oldest, timer = self.timers.popitem(last=False)
+            timer.cancel()
+            self.expire(oldest)
+
+    def take(self, name):
+        """ Stop keeping `name` warm, returns True if it was warm
+        """
+        timer = self.timers.pop(name, None)
+        if timer is None:
+            return False
+        if timer.active():
+            timer.cancel()
+        return True
+
+    def _expire(self, name):
+        del self.timers[name]
+        self.expire(name)
+
+    def stop(self):
+        """ Cancel all expiry timers, leaving the volumes mounted
+        """
+        for timer in self.timers.values():
+            timer.cancel()
+        self.timers.clear()
+
+
+# stat errors from a FUSE mount whose filesystem process has died
+STALE_ERRORS = (errno.ENOTCONN, errno.ESTALE, errno.EIO)
+
+
+class MountProber(object):
+    """Finds mounts which stopped responding
+
+    Every `interval` seconds each (name, path) pair returned by `paths` is
+    checked with `stat`, which runs os.stat off the reactor thread and
+    returns a Deferred failing with `Timeout` if the stat does not return
+    in time. A mount is stale if its stat times out or fails as a dead FUSE
+    mount does, and `on_stale` is then called with its name and path.
+    """
+    def __init__(self, paths, stat, on_stale=None, interval=5,
+                 clock=reactor):
+        self.log = Logger()
+        self.paths = paths
+        self.stat = stat
+        self.on_stale = on_stale
+        self.interval = interval
+        self.clock = clock
+        # path -> (volume name, time it was found stale)
+        self.stale = {}
+        self.pending = set()
+        self.loop = None
+
+    def start(self):
+        if self.interval:
+            self.loop = task.LoopingCall(self.probe_all)
+            self.loop.clock = self.clock
+            self.loop.start(self.interval, now=False)
+
+    def stop(self):
+        if self.loop and self.loop.running:
+            self.loop.stop()
+
+    def is_stale(self, path):
+        return path in self.stale
+
+    def forget(self, path):
+        self.stale.pop(path, None)
+
+    def probe_all(self):
+        return defer.DeferredList(
+            [self.probe(name, path) for name, path in self.paths()])
+
+    def _mark_stale(self, name, path, reason):
+        if path in self.stale:
+            return
+        self.log.error(
+            'Mount of volume {name} on \"{path}\" is stale. {reason}',
+            name=name, path=path, reason=reason
+        )
+        self.stale[path] = (name, self.clock.seconds())
+        if self.on_stale:
+            self.on_stale(name, path)
+
+    def probe(self, name, path):
+        """ Returns a Deferred firing with whether `path` responded in time
+        """
+        if path in self.pending:
+            return defer.succeed(path not in self.stale)
+
+        self.pending.add(path)
+
+        def done(stat):
+            self.pending.discard(path)
+
+            if isinstance(stat, failure.Failure):
+                e = stat.value
+                if isinstance(e, Timeout) or (
+                        getattr(e, 'errno', None) in STALE_ERRORS):
+                    self._mark_stale(name, path, e)
+                    return False
+                # Most likely unmounted since we listed it
+                self.forget(path)
+            elif path in self.stale:
+                self.log.info(
+                    'Mount of volume {name} on \"{path}\" responds again',
+                    name=name, path=path
+                )
+                self.forget(path)
+            return True
+
+        return self.stat(path).addBoth(done)
+
+    def summary(self):
+        """ Describe the stale mounts for a health check
+        """
+        now = self.clock.seconds()
+        return [{
+            'name': name,
+            'path': path,
+            'seconds': now - since,
+        } for path, (name, since) in sorted(self.stale.items())]
@@ -0,0 +1,92 @@
+"""
+Per-volume options passed with `docker volume create -o key=value`.
+
+Only the options below are accepted. Create options are sent to xylem with
+the createvolume job, mount options become glusterfs mount options.
+"""
+
+import math
+
+
+def _choice(*values):
+    def check(value):
+        if value not in values:
+            raise ValueError('must be one of %s' % ', '.join(values))
+        return value
+    return check
+
+
+def _seconds(value):
+    seconds = float(value)
+    if math.isnan(seconds) or math.isinf(seconds):
+        raise ValueError('must be a number of seconds')
+    if seconds < 0:
+        raise ValueError('must not be negative')
+    if seconds == int(seconds):
+        return int(seconds)
+    return seconds
+
+
+def _count(value):
+    if int(value) < 1:
+        raise ValueError('must be at least 1')
+    return int(value)
+
+
+# option -> function validating a value and returning it converted
+CREATE_OPTIONS = {
+    'replica': _count,
+    'transport': _choice('tcp', 'rdma', 'tcp,rdma'),
+}
+
+MOUNT_OPTIONS = {
+    'attribute-timeout': _seconds,
+    'entry-timeout': _seconds,
+    'negative-timeout': _seconds,
+    'direct-io-mode': _choice('enable', 'disable'),
+    'read-ahead': _count,
+    'log-level': _choice(
+        'CRITICAL', 'ERROR', 'WARNING', 'INFO', 'DEBUG', 'TRACE', 'NONE'),
+}
+
+
+def parse_options(opts):
+    """parse_options
+    Validates Docker volume options
+
+    :param opts: dict of option to value, as sent in Create's Opts
+    :returns: dict of option to converted value
+    :raises: ValueError if an option is unknown or its value is invalid
+    """
+    parsed = {}
+    for key, value in (opts or {}).items():
+        check = CREATE_OPTIONS.get(key) or MOUNT_OPTIONS.get(key)
+        if check is None:
+            raise ValueError('Unknown volume option %s' % key)
+        try:
+            parsed[key] = check(str(value))
+        except ValueError, e:
+            raise ValueError('Invalid value for %s, %s' % (key, e))
+    return parsed
+
+
+def create_params(options):
+    """ Returns the createvolume job parameters for `options`
+    """
+    return dict(
+        (k, v) for k, v in options.items() if k in CREATE_OPTIONS)
+
+
+def mount_options(options):
+    """ Returns the glusterfs mount options for `options`
+    """
+    mount = []
+    for key, value in sorted(options.items()):
+        if key not in MOUNT_OPTIONS:
+            continue
+        if key == 'read-ahead':
+            # Pages the read-ahead translator fetches ahead of reads
+            mount.append('xlator-option=*read-ahead.page-count=%s' % value)
+        else:
+            mount.append('%s=%s' % (key, value))
+    return mount
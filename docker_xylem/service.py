@@ -1,12 +1,29 @@
 import os
 import json
 import cgi
+import uuid
+import signal
 
-from twisted.internet import defer
+from twisted.application import service
+from twisted.internet import defer, reactor, task
+from twisted.python import failure
 from twisted.web import server, resource
 
-from docker_xylem import utils
+from docker_xylem import (
+    utils, mounts, journal, catalog, endpoints, logs, tracing, fs, options,
+    diagnostics, control)
 from docker_xylem.compat import Logger
+from docker_xylem.metrics import REGISTRY
+
+# Header which lets xylem recognise a retried job it has already run
+IDEMPOTENCY_HEADER = 'Idempotency-Key'
+
+REQUEST_SECONDS = REGISTRY.histogram(
+    'docker_xylem_request_seconds',
+    'Time taken to answer Docker plugin calls', ['endpoint'])
+REQUEST_ERRORS = REGISTRY.counter(
+    'docker_xylem_request_errors_total',
+    'Docker plugin calls which returned an error', ['endpoint'])
 
 
 class DockerService(resource.Resource):
@@ -27,58 +44,536 @@ class DockerService(resource.Resource):
             '/VolumeDriver.Capabilities': self.capabilities,
         }
 
-        self.xylem_host = config['host']
-        self.xylem_port = config.get('port', 7701)
+        # Per-request traces of where time was spent
+        exporters = []
+        if config.get('trace_file'):
+            exporters.append(tracing.FileExporter(
+                config['trace_file'],
+                max_bytes=config.get('trace_file_size', 10 * 1024 * 1024),
+                backups=config.get('trace_files', 5)
+            ))
+        if config.get('trace_collector'):
+            exporters.append(
+                tracing.SocketExporter(config['trace_collector']))
+        self.tracer = tracing.Tracer(exporters)
+
+        # Reports on anything holding up the reactor, and profiles it on
+        # SIGUSR2
+        self.stall_monitor = diagnostics.StallMonitor(
+            threshold=config.get('stall_threshold', 0.5),
+            interval=config.get('stall_interval', 0.1)
+        )
+        self.profiler = diagnostics.Profiler(
+            config.get('profile_dir', '/var/lib/docker-xylem/profiles'),
+            seconds=config.get('profile_seconds', 30),
+            signum=signal.SIGUSR2 if config.get('profile_signal', True) else 0
+        )
+
+        # Which Docker calls are logged, at what level and how often
+        self.log_policy = logs.RequestLogPolicy(
+            level=config.get('log_level', 'info'),
+            levels=config.get('log_levels', {}),
+            min_level=config.get('log_min_level', 'debug'),
+            sample_rate=config.get('log_sample_rate', 1.0)
+        )
+
+        xylem_hosts = endpoints.parse_hosts(
+            config['host'], config.get('port', 7701))
+        self.xylem = endpoints.EndpointSet(
+            xylem_hosts,
+            self._probe_xylem,
+            interval=config.get('health_interval', 10),
+            breaker_threshold=config.get('xylem_breaker_threshold', 5),
+            breaker_reset=config.get('xylem_breaker_reset', 30),
+            # As many requests at once as the pool keeps connections for
+            max_requests=config.get('http_pool_size', 4)
+        )
+        # Xylem request timeouts follow the latencies seen recently, with
+        # the timeout each call passes as the upper bound
+        self.xylem_timeouts = endpoints.AdaptiveTimeout(
+            percentile=config.get('xylem_timeout_percentile', 0.99),
+            factor=config.get('xylem_timeout_factor', 2),
+            minimum=config.get('xylem_timeout_min', 5)
+        )
+        # Retries of xylem requests which failed in transit and of mounts
+        # which failed while a gluster server was unavailable
+        self.xylem_retry = utils.RetryPolicy(
+            utils.transient_http_error,
+            budget=config.get('xylem_retry_budget', 30)
+        )
+        self.mount_retry = utils.RetryPolicy(
+            utils.transient_mount_error,
+            budget=config.get('mount_retry_budget', 30)
+        )
+        # Gluster servers to mount from, the first is asked for the volume
+        # file and the rest are backups if it is unavailable
+        self.gluster_servers = config.get(
+            'gluster_servers', [host for host, port in xylem_hosts])
+        # Largest xylem response body accepted
+        self.xylem_max_body = config.get('xylem_max_body', 4 * 1024 * 1024)
+        # Submit xylem jobs and poll for their results instead of waiting
+        self.xylem_async = config.get('xylem_async', False)
+        self.xylem_async_timeout = config.get('xylem_async_timeout', 600)
+        self.xylem_poll_interval = config.get('xylem_poll_interval', 0.5)
+        self.xylem_poll_max = config.get('xylem_poll_max', 5)
+        self.clock = reactor
         self.mount_path = config.get(
             'mount_path',
             '/var/lib/docker-xylem/volumes'
         )
         self.old_paths = config.get('old_mount_paths', [])
+        # Options for volumes created without them, overridden by the Opts
+        # each volume is created with
+        self.volume_defaults = options.parse_options(
+            config.get('volume_options', {}))
+        self.volume_opts = {}
+        # Seconds before a hung umount process is killed
+        self.umount_timeout = config.get('umount_timeout', 30)
+        # Seconds before an umount is given up on, for one stuck in the
+        # kernel which even killing does not end
+        self.umount_deadline = config.get(
+            'umount_deadline', self.umount_timeout + 10)
         self.current = {}
+        # Docker mount IDs currently holding a reference to each volume
+        self.mount_refs = {}
+        # Create and Mount calls currently waiting on xylem or /bin/mount
+        self.inflight = utils.SingleFlight()
+        # Docker calls being handled, coalesced or not
+        self.requests_inflight = 0
+
+        # Long lived process which forks mount and umount for us
+        if config.get('mount_helper', False):
+            self.helper = utils.MountHelper(
+                stop_timeout=config.get('mount_helper_stop_timeout', 30))
+        else:
+            self.helper = None
+
+        # Bounds and orders the mount and umount processes we fork
+        self.scheduler = mounts.MountScheduler(
+            config.get('mount_concurrency', 8))
+
+        # Volumes left mounted after their last Unmount in case they are
+        # mounted again soon
+        self.warm = mounts.WarmMounts(
+            self.expire_warm,
+            grace=config.get('warm_mount_grace', 0),
+            limit=config.get('max_warm_mounts', 16)
+        )
+
+        # Index of the kernel mount table
+        self.mounts = mounts.MountTable(
+            config.get('mountinfo', '/proc/self/mountinfo'))
+
+        # Threads for filesystem calls, which hang on a hung gluster mount
+        self.fs = fs.FilesystemExecutor(
+            max_threads=config.get('fs_threads', 4),
+            timeout=config.get('fs_timeout', 10)
+        )
+
+        # Background checks for hung gluster mounts, which are remounted
+        # if remount_stale is set. They have threads of their own, so hung
+        # probes never hold up other filesystem calls.
+        self.probe_fs = fs.FilesystemExecutor(
+            max_threads=config.get('stale_probe_threads', 8),
+            timeout=config.get('stale_probe_timeout', 2)
+        )
+        self.prober = mounts.MountProber(
+            self.probe_paths,
+            self.probe_fs.stat,
+            on_stale=self.stale_mount,
+            interval=config.get('stale_probe_interval', 5)
+        )
+        self.remount_stale = config.get('remount_stale', False)
+
+        # Durable record of current and mount_refs for warm restarts
+        journal_path = config.get(
+            'state_journal', os.path.join(self.mount_path, '.state'))
+        if journal_path:
+            self.journal = journal.StateJournal(journal_path)
+            self.drained_journal = journal.StateJournal(
+                journal_path + '.drained')
+            self.options_journal = journal.OptionsJournal(
+                journal_path + '.options')
+        else:
+            self.journal = None
+            self.drained_journal = None
+            self.options_journal = None
+
+        # Volumes unmounted by the last drain, to be mounted again by a
+        # restore, and the progress of the running drain or restore
+        self.drained = {}
+        self.drain_concurrency = config.get('drain_concurrency', 16)
+        self.operation = None
+
+        # Volumes known to xylem, including those not mounted on this host
+        self.catalog = catalog.VolumeCatalog(
+            self.list_xylem_volumes,
+            interval=config.get('catalog_refresh', 60),
+            ttl=config.get('catalog_ttl', 300)
+        )
+
+        # Volumes recently created here, so repeat Creates skip xylem
+        self.created = catalog.CreateCache(
+            ttl=config.get('create_cache_ttl', 300))
+
+        # Keep-alive connections to xylem shared by every request
+        self.pool = utils.connection_pool(
+            max_per_host=config.get('http_pool_size', 4),
+            idle_timeout=config.get('http_pool_idle_timeout', 240)
+        )
+
+        REGISTRY.gauge(
+            'docker_xylem_inflight_requests',
+            'Docker calls currently being handled',
+            lambda: self.requests_inflight)
+        REGISTRY.gauge(
+            'docker_xylem_create_cache_size',
+            'Volumes whose Create result is cached',
+            lambda: len(self.created))
+        REGISTRY.gauge(
+            'docker_xylem_mounted_volumes',
+            'Volumes mounted by the plugin on this host',
+            lambda: len(self.current))
+        REGISTRY.gauge(
+            'docker_xylem_mount_queue_depth',
+            'Mount and umount operations waiting to run',
+            lambda: self.scheduler.depth)
+
+    def start(self):
+        """ Called when the plugin service starts
+        """
+        self.stall_monitor.start()
+        self.profiler.start()
+        self.restore_state()
+        self.catalog.start()
+        self.xylem.start()
+        self.prober.start()
+        if self.helper:
+            self.helper.start()
+
+    def stop(self):
+        """ Called when the plugin service stops. Returns a Deferred which
+        fires once all resources are released
+        """
+        self.stall_monitor.stop()
+        self.profiler.stop()
+        self.catalog.stop()
+        self.xylem.stop()
+        self.prober.stop()
+        self.probe_fs.stop()
+        self.fs.stop()
+        self.warm.stop()
+        self.tracer.stop()
+        for state in (self.journal, self.drained_journal,
+                      self.options_journal):
+            if state:
+                state.close()
+        self.mounts.close()
+
+        stopping = [self.pool.closeCachedConnections()]
+        if self.helper:
+            stopping.append(self.helper.stop())
+        return defer.gatherResults(stopping)
+
+    def restore_state(self):
+        """ Rebuild the mounted volumes from the state journal, dropping any
+        which are no longer in the kernel mount table
+        """
+        if self.drained_journal:
+            self.drained = self.drained_journal.load()
+
+        if self.options_journal:
+            self.volume_opts = self.options_journal.load()
+
+        if not self.journal:
+            return
+
+        state = self.journal.load()
+        for name, (path, refs) in state.items():
+            if self.mounts.available and not self.mounts.is_mounted(path):
+                self.log.warn(
+                    'Volume {name} is no longer mounted on \"{path}\"',
+                    name=name, path=path
+                )
+                del state[name]
+                continue
+
+            self.current[name] = path
+            self.mount_refs[name] = set(refs)
+            if not refs:
+                # Was warm when we stopped
+                self.warm.add(name)
+
+        self.journal.compact(state)
+        self.log.info(
+            'Restored {count} mounted volumes from {path}',
+            count=len(state), path=self.journal.path
+        )
+
+    def record_state(self, name):
+        """ Write the current state of a volume to the journal
+        """
+        if self.journal:
+            self.journal.record(
+                name, self.current.get(name), self.mount_refs.get(name))
+
+    def record_options(self, name):
+        """ Write the options of a volume to the options journal
+        """
+        if self.options_journal:
+            self.options_journal.record(name, self.volume_opts.get(name))
+
+    def _xylem_http(self, path, method='GET', data=None, timeout=60,
+                    kind=None, idempotency_key=None, waits=False,
+                    trace=tracing.NULL_TRACE):
+        """ Make a request to the best xylem endpoint
+
+        :param timeout: Longest the request may take, it is cut shorter once
+            requests of the same `kind` (by default `path`) have been seen
+        :param waits: True for a request which waits for a xylem job to run,
+            so its latency depends on the job rather than xylem's health.
+            It always gets the full `timeout` and is not held to the
+            endpoint's limit on requests at once, which would queue other
+            requests behind the job.
+        """
+        kind = kind or path
+        if not waits:
+            timeout = self.xylem_timeouts.timeout(kind, timeout)
+        headers = {}
+        if idempotency_key:
+            headers[IDEMPOTENCY_HEADER] = [idempotency_key]
+        if trace.id:
+            headers[tracing.TRACE_HEADER] = [trace.id]
 
-    def xylem_request(self, queue, call, data):
+        def request(endpoint):
+            queued = self.clock.seconds()
+            if waits:
+                return send(endpoint, queued)
+            # Time spent waiting for a slot counts against the timeout
+            return utils.deadline(
+                endpoint.limit(send, endpoint, queued), timeout,
+                "Request took longer than %s seconds" % timeout,
+                clock=self.clock)
+
+        def send(endpoint, queued):
+            start = self.clock.seconds()
+            remaining = timeout - (start - queued)
+            if remaining <= 0:
+                # Gave up while waiting for the slot
+                return None
+
+            def observe(result):
+                if waits:
+                    return result
+                if not isinstance(result, failure.Failure):
+                    self.xylem_timeouts.observe(
+                        kind, self.clock.seconds() - start)
+                elif result.check(utils.Timeout):
+                    self.xylem_timeouts.observe(kind, timeout)
+                return result
+
+            return trace.span(
+                'http_request', method=method, url=endpoint.url(path)
+            ).run(utils.HTTPRequest(
+                timeout=remaining, pool=self.pool,
+                max_body=self.xylem_max_body
+            ).getJson,
+                endpoint.url(path),
+                method=method,
+                headers=headers,
+                data=data,
+            ).addBoth(observe)
+
+        return defer.maybeDeferred(self.xylem.choose).addCallback(
+            lambda endpoint: self.xylem.call(request, endpoint))
+
+    def _probe_xylem(self, endpoint):
+        # Any HTTP response at all means the endpoint is up. Not held to the
+        # endpoint's limit, so a busy endpoint is not reported as down
+        return utils.HTTPRequest(timeout=5, pool=self.pool).getBody(
+            endpoint.url('/'))
+
+    def xylem_request(self, queue, call, data, idempotency_key=None,
+                      trace=tracing.NULL_TRACE):
+        """ Run a xylem job and return its result
+
+        :param idempotency_key: Sent with the job so xylem runs it only once
+            however many times the request is retried
+        """
         self.log.info(
-            'Xylem HTTP request to create volume {name}',
-            name=data['name']
+            'Xylem HTTP request {call} on queue {queue}',
+            queue=queue, call=call
         )
-        return utils.HTTPRequest(timeout=60).getJson(
-            'http://%s:%s/queues/%s/wait/%s' % (
-                self.xylem_host, self.xylem_port, queue, call
-            ),
+        if self.xylem_async:
+            return self.xylem_submit(queue, call, data, idempotency_key, trace)
+
+        # Waits for the job to run, which takes seconds or minutes depending
+        # on the job
+        return self.xylem_retry.run(
+            self._xylem_http,
+            '/queues/%s/wait/%s' % (queue, call),
+            method='POST',
+            data=json.dumps(data),
+            idempotency_key=idempotency_key,
+            waits=True,
+            trace=trace,
+        )
+
+    @defer.inlineCallbacks
+    def xylem_submit(self, queue, call, data, idempotency_key=None,
+                     trace=tracing.NULL_TRACE):
+        """ Queue a xylem job and poll for its result with backoff, so no
+        connection is held open while the job runs
+        """
+        job = yield self.xylem_retry.run(
+            self._xylem_http,
+            '/queues/%s/%s' % (queue, call),
             method='POST',
             data=json.dumps(data),
+            timeout=10,
+            idempotency_key=idempotency_key,
+            trace=trace,
         )
+        job_id = job['id']
+
+        deadline = self.clock.seconds() + self.xylem_async_timeout
+        delay = self.xylem_poll_interval
+        while True:
+            yield task.deferLater(self.clock, delay, lambda: None)
+
+            result = yield self.xylem_retry.run(
+                self._xylem_http,
+                '/queues/%s/result/%s' % (queue, job_id), timeout=10,
+                kind='/queues/%s/result' % queue, trace=trace)
+            if result.get('result') is not None:
+                defer.returnValue(result)
+
+            if self.clock.seconds() >= deadline:
+                raise utils.Timeout(
+                    "Xylem job %s took longer than %s seconds" % (
+                        job_id, self.xylem_async_timeout))
+
+            delay = min(delay * 2, self.xylem_poll_max)
+
+    @defer.inlineCallbacks
+    def list_xylem_volumes(self):
+        """ Fetch the names of all volumes known to xylem
+        """
+        result = yield self.xylem_request('gluster', 'listvolumes', {})
+
+        names = []
+        for volume in result['result']:
+            if isinstance(volume, dict):
+                names.append(volume['name'])
+            else:
+                names.append(volume)
+
+        defer.returnValue(names)
 
     def _fork(self, *args, **kw):
+        if self.helper:
+            return self.helper.run(*args, **kw)
         return utils.fork(*args, **kw)
 
+    def probe_paths(self):
+        """ Returns the (name, path) of every mount the prober checks
+        """
+        paths = self.current.items()
+        if self.mounts.available:
+            for old_path in self.old_paths:
+                paths.extend(self.mounts.mounted_under(old_path).items())
+        return paths
+
+    def stale_mount(self, name, path):
+        """ Called by the prober when the mount of `name` on `path` hangs
+        """
+        if self.remount_stale:
+            self.scheduler.serialize(name, self._remount, name, path)
+
     @defer.inlineCallbacks
-    def _mount_fs(self, server, volume, dst):
-        """ Mount a gluster filesystem on this host
+    def _lazy_umount(self, path):
+        """ Detach the mount on `path`, which works even while it hangs
         """
+        out, err, code = yield self.scheduler.limit(
+            mounts.PRIORITY_UNMOUNT, self._fork, '/bin/umount',
+            args=('-l', path), timeout=self.umount_timeout)
+        if code > 0:
+            raise Exception(err)
 
+    @defer.inlineCallbacks
+    def _remount(self, name, path):
+        """ Lazily unmount a stale mount and mount it again if it is still
+        in use
+        """
         try:
-            os.makedirs(dst)
-        except os.error, e:
-            # Raise any error except path exists
-            if e.errno != 17:
-                raise e
+            yield self._lazy_umount(path)
 
-        out, err, code = yield self._fork('/bin/mount', args=(
-            '-t', 'glusterfs', '%s:/%s' % (server, volume), dst))
+            if self.current.get(name) == path:
+                yield self.mount_retry.run(
+                    self.scheduler.limit, mounts.PRIORITY_MOUNT,
+                    self._mount_fs, self.gluster_servers[0], name, path,
+                    self.gluster_servers[1:], self.mount_options(name))
+            self.log.info(
+                'Remounted stale volume {name} on \"{path}\"',
+                name=name, path=path
+            )
+        except Exception, e:
+            self.log.error(
+                'Error remounting stale volume {name} on \"{path}\". '
+                '\"{e}\"', name=name, path=path, e=e
+            )
+        else:
+            self.prober.forget(path)
+
+    def health(self):
+        """ Summary of mount and xylem liveness for health checks
+        """
+        stale = self.prober.summary()
+        return {
+            'healthy': not stale,
+            'mounts': len(self.current),
+            'stale': stale,
+            'xylem': [{
+                'endpoint': '%s:%s' % (e.host, e.port),
+                'healthy': e.healthy,
+                'circuit': e.breaker.state,
+            } for e in self.xylem.endpoints],
+        }
+
+    @defer.inlineCallbacks
+    def _mount_fs(self, server, volume, dst, backups=(), mount_options=(),
+                  trace=tracing.NULL_TRACE):
+        """ Mount a gluster filesystem on this host
+        """
+
+        yield trace.span('makedirs', path=dst).run(self.fs.makedirs, dst)
+
+        mount_options = list(mount_options)
+        if backups:
+            mount_options.insert(
+                0, 'backup-volfile-servers=%s' % ':'.join(backups))
+
+        args = ('-t', 'glusterfs')
+        if mount_options:
+            args += ('-o', ','.join(mount_options))
+
+        out, err, code = yield trace.span('mount', path=dst).run(
+            self._fork, '/bin/mount', args=args + (
+                '%s:/%s' % (server, volume), dst))
 
         if code > 0:
-            raise Exception(err)
+            raise utils.MountError(err, code)
 
         else:
             defer.returnValue(True)
 
     @defer.inlineCallbacks
-    def _umount_fs(self, path):
+    def _umount_fs(self, path, timeout=3600, trace=tracing.NULL_TRACE):
         """ Mount a gluster filesystem on this host
         """
 
-        out, err, code = yield self._fork('/bin/umount', args=(path,))
+        out, err, code = yield trace.span('umount', path=path).run(
+            self._fork, '/bin/umount', args=(path,), timeout=timeout)
 
         if code > 0:
 
@@ -94,22 +589,80 @@ class DockerService(resource.Resource):
             self.log.info('Successfully unmounted {path}', path=path)
             defer.returnValue(True)
 
-    @defer.inlineCallbacks
     def mount_volume(self, request, data):
         name = data['Name']
+        mount_id = data.get('ID')
         path = os.path.join(self.mount_path, name)
 
+        refs = self.mount_refs.get(name)
+        if refs and self.prober.is_stale(self.current.get(name, path)):
+            return {"Err": "Mount of volume %s is stale" % name}
+
+        if refs:
+            # Already mounted on this host, just take another reference
+            refs.add(mount_id)
+            self.record_state(name)
+            self.log.info(
+                'Volume {name} already mounted, {count} references held',
+                name=name, count=len(refs)
+            )
+            return {
+                "Mountpoint": self.current.get(name, path),
+                "Err": None
+            }
+
+        return self.scheduler.serialize(
+            name, self._mount_volume, name, mount_id, path,
+            self.get_trace(request))
+
+    @defer.inlineCallbacks
+    def _mount_volume(self, name, mount_id, path, trace=tracing.NULL_TRACE):
+        # An earlier call may have mounted the volume while this one waited
+        mounted = bool(self.mount_refs.get(name))
         try:
-            yield self._mount_fs(self.xylem_host, name, path)
+            warm_path = self.current.get(name, path)
+            if (name in self.warm) and self.prober.is_stale(warm_path):
+                # Never hand out a hung mount, detach it and mount afresh
+                self.log.warn(
+                    'Warm mount of {name} on \"{path}\" is stale, remounting',
+                    name=name, path=warm_path
+                )
+                self.warm.take(name)
+                yield self._lazy_umount(warm_path)
+                self.current.pop(name, None)
+                self.prober.forget(warm_path)
+
+            elif self.warm.take(name):
+                self.log.info(
+                    'Volume {name} was still mounted, reusing it', name=name)
+                mounted = True
+
+            if not mounted and self.mounts.is_mounted(path):
+                self.log.info(
+                    'Volume {name} is already mounted on \"{path}\"',
+                    name=name, path=path
+                )
+                mounted = True
+
+            if not mounted:
+                yield self.inflight.run(
+                    ('mount', name), self.mount_retry.run,
+                    self.scheduler.limit, mounts.PRIORITY_MOUNT,
+                    self._mount_fs,
+                    self.gluster_servers[0], name, path,
+                    self.gluster_servers[1:], self.mount_options(name),
+                    trace=trace)
 
+            self.mount_refs.setdefault(name, set()).add(mount_id)
             if name not in self.current:
                 self.current[name] = path
+            self.record_state(name)
             self.log.info(
                 'Successfully mounted volume {name}. Mount path:\"{path}\"',
                 name=name, path=path
             )
             defer.returnValue({
-                "Mountpoint": path,
+                "Mountpoint": self.current[name],
                 "Err": None
             })
 
@@ -118,32 +671,213 @@ class DockerService(resource.Resource):
                 'Error mounting {name}. \"{e.message}\"',
                 name=name, e=e
             )
+            # The volume may not exist after all, check with xylem on the
+            # next Create
+            self.created.remove(name)
             defer.returnValue({"Err": repr(e)})
 
-    @defer.inlineCallbacks
     def unmount_volume(self, request, data):
-        name = data['Name']
-        try:
-            paths = self.get_paths(name)
-            for path in paths:
+        return self.scheduler.serialize(
+            data['Name'], self._unmount_volume, data['Name'], data.get('ID'),
+            self.get_trace(request))
+
+    @defer.inlineCallbacks
+    def _unmount_volume(self, name, mount_id, trace=tracing.NULL_TRACE):
+        refs = self.mount_refs.get(name)
+        if refs:
+            refs.discard(mount_id)
+            if refs:
+                self.record_state(name)
                 self.log.info(
-                    'Attemptting to unmount {name} from \"{path}\"',
-                    name=name, path=path
+                    'Volume {name} still in use, {count} references held',
+                    name=name, count=len(refs)
                 )
-                yield self._umount_fs(path)
+                defer.returnValue({"Err": None})
 
+        if self.warm.grace and (name in self.current):
+            self.warm.add(name)
+            self.record_state(name)
             self.log.info(
-                'Volume {name} unmounted from all mount paths.',
-                name=name
+                'Volume {name} no longer in use, keeping it mounted for '
+                '{grace} seconds', name=name, grace=self.warm.grace
             )
             defer.returnValue({"Err": None})
 
-        except Exception, e:
+        result = yield self.release_volume(name, trace)
+        defer.returnValue(result)
+
+    def expire_warm(self, name):
+        """ Unmount a volume which has been kept warm
+        """
+        def expire():
+            if self.mount_refs.get(name) or (name in self.warm):
+                # Mounted again while waiting for the volume
+                return
+            return self.release_volume(name)
+
+        return self.scheduler.serialize(name, expire)
+
+    @defer.inlineCallbacks
+    def release_volume(self, name, trace=tracing.NULL_TRACE):
+        """ Unmount a volume from every path and forget it
+        """
+        outcomes = yield self.unmount_paths(name, trace)
+        errors = [
+            '%s: %s' % (path, outcome)
+            for path, outcome in sorted(outcomes.items())
+            if isinstance(outcome, Exception)
+        ]
+
+        if errors:
             self.log.error(
-                'Error unmounting volume {name}. \"{e.message}\"',
-                name=name, e=e
+                'Error unmounting volume {name}. {outcomes}',
+                name=name, outcomes=self.describe_outcomes(outcomes)
             )
-            defer.returnValue({"Err": repr(e)})
+            defer.returnValue({"Err": '; '.join(errors)})
+
+        self.mount_refs.pop(name, None)
+        self.current.pop(name, None)
+        self.record_state(name)
+        self.log.info(
+            'Volume {name} unmounted from all mount paths. {outcomes}',
+            name=name, outcomes=self.describe_outcomes(outcomes)
+        )
+        defer.returnValue({"Err": None})
+
+    @defer.inlineCallbacks
+    def unmount_paths(self, name, trace=tracing.NULL_TRACE):
+        """
+        Function to unmount a volume from every mount path concurrently
+        :param name: Name of volume
+        :return: dict of path to True if it was unmounted, False if it was
+            not mounted, or the exception raised unmounting it
+        """
+        paths = [
+            path for path in self.get_paths(name)
+            if self.mounts.is_mounted(path) or not self.mounts.available
+        ]
+
+        def umount(path):
+            return utils.deadline(
+                self._umount_fs(path, self.umount_timeout, trace=trace),
+                self.umount_deadline,
+                "Unmounting %s took longer than %s seconds" % (
+                    path, self.umount_deadline),
+                clock=self.clock)
+
+        results = yield defer.DeferredList([
+            self.scheduler.limit(mounts.PRIORITY_UNMOUNT, umount, path)
+            for path in paths
+        ], consumeErrors=True)
+
+        outcomes = {}
+        for path, (success, result) in zip(paths, results):
+            outcomes[path] = result if success else result.value
+        defer.returnValue(outcomes)
+
+    def describe_outcomes(self, outcomes):
+        """ Summarise the result of unmount_paths for the log
+        """
+        described = []
+        for path, outcome in sorted(outcomes.items()):
+            if isinstance(outcome, Exception):
+                outcome = 'error "%s"' % outcome
+            elif outcome:
+                outcome = 'unmounted'
+            else:
+                outcome = 'not mounted'
+            described.append('%s: %s' % (path, outcome))
+        return ', '.join(described) or 'No paths were mounted'
+
+    def maintenance_status(self):
+        """ Summary of drained volumes and the last drain or restore
+        """
+        return {
+            'mounted': len(self.current),
+            'drained': len(self.drained),
+            'last': self.operation.to_dict() if self.operation else None,
+        }
+
+    def _start_bulk(self, kind, names):
+        if self.operation and self.operation.running:
+            raise control.Busy('A %s is already running' % (
+                self.operation.kind))
+        self.operation = control.BulkOperation(kind, names)
+        return self.operation
+
+    def _save_drained(self):
+        if self.drained_journal:
+            self.drained_journal.compact(self.drained)
+
+    def drain(self, concurrency=None):
+        """ Unmount every volume on this host, including from the old mount
+        paths, up to `concurrency` volumes at a time. The volumes are
+        remembered so `restore` can mount them again.
+
+        :returns: Deferred firing with the outcome of the drain
+        """
+        names = set(self.current)
+        if self.mounts.available:
+            for old_path in self.old_paths:
+                names.update(self.mounts.mounted_under(old_path))
+
+        operation = self._start_bulk('drain', names)
+        for name, path in self.current.items():
+            self.drained[name] = (
+                path, sorted(self.mount_refs.get(name) or []))
+        self._save_drained()
+
+        return control.run_bulk(
+            operation, self._drain_volume, [(name,) for name in sorted(names)],
+            concurrency or self.drain_concurrency)
+
+    def _drain_volume(self, name):
+        def drain():
+            self.warm.take(name)
+            return self.release_volume(name)
+
+        return self.scheduler.serialize(name, drain)
+
+    def restore(self, concurrency=None):
+        """ Mount the volumes unmounted by `drain` again, up to
+        `concurrency` volumes at a time
+
+        :returns: Deferred firing with the outcome of the restore
+        """
+        operation = self._start_bulk('restore', self.drained)
+        return control.run_bulk(operation, self._restore_volume, [
+            (name, path, refs)
+            for name, (path, refs) in sorted(self.drained.items())
+        ], concurrency or self.drain_concurrency)
+
+    def _restore_volume(self, name, path, refs):
+        @defer.inlineCallbacks
+        def restore():
+            try:
+                if name not in self.current:
+                    yield self.inflight.run(
+                        ('mount', name), self.mount_retry.run,
+                        self.scheduler.limit, mounts.PRIORITY_MOUNT,
+                        self._mount_fs, self.gluster_servers[0], name, path,
+                        self.gluster_servers[1:], self.mount_options(name))
+                    self.current[name] = path
+
+                held = self.mount_refs.setdefault(name, set())
+                held.update(refs)
+                if not held:
+                    # Was kept warm when it was drained
+                    self.warm.add(name)
+                self.record_state(name)
+            except Exception, e:
+                self.log.error(
+                    'Error restoring volume {name}. \"{e}\"', name=name, e=e)
+                defer.returnValue({"Err": repr(e)})
+
+            del self.drained[name]
+            self._save_drained()
+            defer.returnValue({"Err": None})
+
+        return self.scheduler.serialize(name, restore)
 
     def get_paths(self, name):
         """
@@ -155,9 +889,22 @@ class DockerService(resource.Resource):
         paths.append(os.path.join(self.mount_path, name))
         return paths
 
+    def volume_options(self, name):
+        """ Returns the options of volume `name`, including defaults
+        """
+        opts = dict(self.volume_defaults)
+        opts.update(self.volume_opts.get(name, {}))
+        return opts
+
+    def mount_options(self, name):
+        return options.mount_options(self.volume_options(name))
+
     def get_volume_path(self, request, data):
         name = data['Name']
         path = os.path.join(self.mount_path, name)
+        if self.prober.is_stale(self.current.get(name, path)):
+            return {"Err": "Mount of volume %s is stale" % name}
+
         return {
             "Mountpoint": path,
             "Err": None
@@ -165,15 +912,40 @@ class DockerService(resource.Resource):
 
     def remove_volume(self, request, data):
         # FIXME: This probably isn't supposed to do nothing.
+        self.catalog.remove(data['Name'])
+        self.created.remove(data['Name'])
+        if self.volume_opts.pop(data['Name'], None) is not None:
+            self.record_options(data['Name'])
         return {"Err": None}
 
     @defer.inlineCallbacks
     def create_volume(self, request, data):
         name = data['Name']
 
-        result = yield self.xylem_request('gluster', 'createvolume', {
-            'name': name
-        })
+        try:
+            opts = options.parse_options(data.get('Opts'))
+        except ValueError, e:
+            self.log.error(
+                'Error creating volume {name}. \"{e}\"', name=name, e=e)
+            defer.returnValue({"Err": str(e)})
+
+        if self.created.hit(name, opts):
+            self.log.debug(
+                'Volume {name} was created recently, not asking xylem',
+                name=name)
+            defer.returnValue({"Err": None})
+
+        params = options.create_params(self.volume_defaults)
+        params.update(options.create_params(opts))
+        params['name'] = name
+
+        trace = self.get_trace(request)
+        # Only Creates asking for the same options share a xylem job
+        result = yield self.inflight.run(
+            ('create', name, tuple(sorted(opts.items()))),
+            trace.span('xylem_request', call='createvolume').run,
+            self.xylem_request, 'gluster', 'createvolume', params,
+            idempotency_key=uuid.uuid4().hex, trace=trace)
 
         if not result['result']['running']:
             self.log.error(
@@ -183,18 +955,52 @@ class DockerService(resource.Resource):
             err = "Error creating volume %s" % name
         else:
             err = None
+            self.catalog.add(name)
+            if self.volume_opts.get(name, {}) != opts:
+                self.volume_opts[name] = opts
+                self.record_options(name)
+            self.created.add(name, opts)
+            self.log.info(
+                'Successfully created the volume {name}.', name=name)
 
-        self.log.info('Successfully created the volume {name}.', name=name)
         defer.returnValue({"Err": err})
 
+    def get_mounted(self):
+        """
+        Function to return the volumes mounted on this host
+        :return: dict of volume name to mount point
+        """
+        if not self.mounts.available:
+            return self.current
+
+        mounted = self.mounts.mounted_under(self.mount_path)
+        for name, path in self.current.items():
+            if self.mounts.is_mounted(path):
+                mounted[name] = path
+        return mounted
+
     def get_volume(self, request, data):
         name = data['Name']
+        mounted = self.get_mounted()
 
-        if name in self.current:
+        if name in mounted:
+            status = {}
+            if self.prober.is_stale(mounted[name]):
+                status['Stale'] = True
+            return {
+                'Volume': {
+                    'Name': name,
+                    'Mountpoint': mounted[name],
+                    'Status': status
+                },
+                'Err': None
+            }
+        elif name in self.catalog:
+            # Known to xylem but not mounted on this host
             return {
                 'Volume': {
                     'Name': name,
-                    'Mountpoint': self.current[name],
+                    'Mountpoint': '',
                     'Status': {}
                 },
                 'Err': None
@@ -204,13 +1010,21 @@ class DockerService(resource.Resource):
 
     def list_volumes(self, request, data):
         vols = []
+        mounted = self.get_mounted()
 
-        for k, v in self.current.items():
+        for k, v in mounted.items():
             vols.append({
                 'Name': k,
                 'Mountpoint': v
             })
 
+        for k in self.catalog.names():
+            if k not in mounted:
+                vols.append({
+                    'Name': k,
+                    'Mountpoint': ''
+                })
+
         return {'Volumes': vols, 'Err': None}
 
     def capabilities(self, request, data):
@@ -232,6 +1046,11 @@ class DockerService(resource.Resource):
         request.write(response)
         request.finish()
 
+    def get_trace(self, request):
+        """ Returns the trace of the Docker call being handled
+        """
+        return getattr(request, 'trace', tracing.NULL_TRACE)
+
     def _route_request(self, request):
         cnt = request.content.read()
         if cnt:
@@ -247,17 +1066,75 @@ class DockerService(resource.Resource):
                 request=request
             )
             return "Not Implemented"
-        self.log.info(
-            '{request.path} called. data={data}',
-            request=request, data=data
-        )
-        return defer.maybeDeferred(method, request, data)
+
+        level = self.log_policy.level_for(request.path)
+        if level:
+            getattr(self.log, level)(
+                '{request.path} called. data={data}',
+                request=request, data=logs.LazyJSON(data)
+            )
+        start = self.clock.seconds()
+        request.trace = self.tracer.trace(request.path)
+        self.requests_inflight += 1
+
+        def observe(result):
+            self.requests_inflight -= 1
+            REQUEST_SECONDS.observe(
+                self.clock.seconds() - start, endpoint=request.path)
+            if isinstance(result, failure.Failure):
+                # Answer Docker rather than leaving it to time out
+                self.log.error(
+                    'Error handling {path}. \"{e}\"',
+                    path=request.path, e=result.value)
+                error = str(result.value)
+                result = {"Err": error}
+            elif isinstance(result, dict):
+                error = result.get('Err')
+            else:
+                error = None
+            if error:
+                REQUEST_ERRORS.inc(endpoint=request.path)
+            request.trace.finish(error)
+            return result
+
+        return defer.maybeDeferred(method, request, data).addBoth(observe)
 
     def render_POST(self, request):
         request.setHeader("content-type", "application/json")
 
-        self.log.info('{request.path}', request=request)
-
         self._route_request(request).addCallback(self.completeCall, request)
 
         return server.NOT_DONE_YET
+
+
+class HealthResource(resource.Resource):
+    """ Serves `DockerService.health`, with a 503 status while any mount is
+    stale
+    """
+    isLeaf = True
+
+    def __init__(self, docker):
+        resource.Resource.__init__(self)
+        self.docker = docker
+
+    def render_GET(self, request):
+        health = self.docker.health()
+        if not health['healthy']:
+            request.setResponseCode(503)
+        request.setHeader('Content-Type', 'application/json')
+        return json.dumps(health)
+
+
+class DockerPluginService(service.Service):
+    """ Ties the lifetime of a DockerService to the twistd application
+    """
+    def __init__(self, docker):
+        self.docker = docker
+
+    def startService(self):
+        service.Service.startService(self)
+        self.docker.start()
+
+    def stopService(self):
+        service.Service.stopService(self)
+        return self.docker.stop()
@@ -1,10 +1,18 @@
+import os
 import json
+import pstats
+import threading
 from StringIO import StringIO
 
 from twisted.trial import unittest
-from twisted.internet import defer
+from twisted.internet import defer, task, error
+from twisted.web.test.requesthelper import DummyRequest
 
-from docker_xylem.service import DockerService
+from docker_xylem.service import DockerService, HealthResource
+from docker_xylem.compat import Logger
+from docker_xylem import (
+    mounts, journal, utils, metrics, benchmark, endpoints, logs, tracing, fs,
+    options, diagnostics, control)
 
 
 class FakeRequest(object):
@@ -13,22 +21,46 @@ class FakeRequest(object):
         self.path = path
 
 
+class SyncFilesystem(fs.FilesystemExecutor):
+    """ Runs filesystem calls immediately, on the reactor thread
+    """
+    def run(self, f, *args, **kw):
+        return defer.maybeDeferred(f, *args)
+
+
+MOUNTINFO = '''\
+22 1 8:1 / / rw,relatime shared:1 - ext4 /dev/sda1 rw
+40 22 0:38 / /tmp/docker-xylem-test/testvol rw shared:20 - fuse.glusterfs \
+localhost:/testvol rw,user_id=0,group_id=0
+41 22 0:39 / /just/one/more/wont/hurt/testvol rw - fuse.glusterfs \
+localhost:/testvol rw,user_id=0,group_id=0
+42 22 0:40 / /tmp/docker-xylem-test/other\\040vol rw - fuse.glusterfs \
+localhost:/other\\040vol rw
+'''
+
+
 class Test(unittest.TestCase):
 
     def setUp(self):
         self.service = DockerService({
             'host': 'localhost',
             'mount_path': '/tmp/docker-xylem-test',
+            'mountinfo': None,
+            'state_journal': None,
+            'catalog_refresh': 0,
+            'stale_probe_interval': 0,
+            'stall_threshold': 0,
             'old_mount_paths': [
                 '/some/old/path', '/another/random/old/path',
                 '/just/one/more/wont/hurt'
             ]
         })
 
-        self.service.xylem_request = lambda *a: defer.maybeDeferred(
+        self.service.xylem_request = lambda *a, **kw: defer.maybeDeferred(
             self.xylem_request, *a)
 
         self.service._fork = self.fork
+        self.service.fs = SyncFilesystem()
 
     def fork(self, *args, **kw):
         """
@@ -48,6 +80,9 @@ class Test(unittest.TestCase):
                 "id": "8bda3daa-4fe8-4021-8acd-4100ea2833fb"
             }}
 
+        if call == 'listvolumes':
+            return {"result": [{"name": "testvol"}, {"name": "othervol"}]}
+
         return {}
 
     @defer.inlineCallbacks
@@ -178,3 +213,1619 @@ class Test(unittest.TestCase):
 
         # Restore the old test fork function?
         self.service._fork = self.fork
+
+    def test_unmount_deadline(self):
+        """
+        An umount which never returns fails its path after the deadline,
+        without holding up the other paths
+        """
+        clock = task.Clock()
+        stuck = '/tmp/docker-xylem-test/testvol'
+
+        def fork(executable, args=(), **kw):
+            if executable == '/bin/umount' and args == (stuck,):
+                return defer.Deferred()
+            return defer.succeed(("", "", 0))
+
+        self.service.clock = clock
+        self.service._fork = fork
+        self.service.umount_deadline = 40
+
+        d = self.service.unmount_paths('testvol')
+        self.assertNoResult(d)
+        clock.advance(40)
+
+        outcomes = self.successResultOf(d)
+        self.assertIsInstance(outcomes.pop(stuck), utils.Timeout)
+        self.assertEquals(set(outcomes.values()), set([True]))
+        self.assertEquals(self.service.scheduler.running, 0)
+
+    @defer.inlineCallbacks
+    def test_mount_refcount(self):
+        """
+        Only the first Mount and the last Unmount of a volume should fork
+        """
+        calls = []
+
+        def fork(*args, **kw):
+            calls.append(args[0])
+            return defer.succeed(("", "", 0))
+
+        self.service._fork = fork
+
+        for mount_id in ('one', 'two'):
+            result = yield self.service._route_request(FakeRequest(
+                '/VolumeDriver.Mount', {'Name': 'testvol', 'ID': mount_id}))
+            self.assertEquals(result['Err'], None)
+
+        self.assertEquals(calls, ['/bin/mount'])
+
+        result = yield self.service._route_request(FakeRequest(
+            '/VolumeDriver.Unmount', {'Name': 'testvol', 'ID': 'one'}))
+        self.assertEquals(result['Err'], None)
+        self.assertEquals(calls, ['/bin/mount'])
+        self.assertIn('testvol', self.service.current)
+
+        result = yield self.service._route_request(FakeRequest(
+            '/VolumeDriver.Unmount', {'Name': 'testvol', 'ID': 'two'}))
+        self.assertEquals(result['Err'], None)
+        self.assertEquals(calls, ['/bin/mount'] + ['/bin/umount'] * 4)
+        self.assertNotIn('testvol', self.service.current)
+
+    def test_connection_pool(self):
+        """
+        The service owns one persistent pool configured from the config
+        """
+        service = DockerService({
+            'host': 'localhost',
+            'http_pool_size': 8,
+            'http_pool_idle_timeout': 30
+        })
+
+        self.assertTrue(service.pool.persistent)
+        self.assertEquals(service.pool.maxPersistentPerHost, 8)
+        self.assertEquals(service.pool.cachedConnectionTimeout, 30)
+
+        return service.stop()
+
+    @defer.inlineCallbacks
+    def test_concurrent_mount(self):
+        """
+        Concurrent Mounts of one volume should share a single /bin/mount
+        """
+        forks = []
+
+        def fork(*args, **kw):
+            d = defer.Deferred()
+            forks.append(d)
+            return d
+
+        self.service._fork = fork
+
+        d1 = self.service._route_request(FakeRequest(
+            '/VolumeDriver.Mount', {'Name': 'testvol', 'ID': 'one'}))
+        d2 = self.service._route_request(FakeRequest(
+            '/VolumeDriver.Mount', {'Name': 'testvol', 'ID': 'two'}))
+
+        self.assertEquals(len(forks), 1)
+        self.assertEquals(len(self.service.inflight), 1)
+        forks[0].callback(("", "", 0))
+
+        result1 = yield d1
+        result2 = yield d2
+        self.assertEquals(result1['Err'], None)
+        self.assertEquals(result2['Err'], None)
+        self.assertEquals(len(self.service.inflight), 0)
+        self.assertEquals(
+            self.service.mount_refs['testvol'], set(['one', 'two']))
+
+    @defer.inlineCallbacks
+    def test_concurrent_create(self):
+        """
+        Concurrent Creates of one volume should send a single xylem job
+        """
+        jobs = []
+
+        def xylem_request(queue, call, data, **kw):
+            jobs.append(defer.Deferred())
+            return jobs[-1]
+
+        self.service.xylem_request = xylem_request
+
+        d1 = self.service._route_request(FakeRequest(
+            '/VolumeDriver.Create', {'Name': 'testvol', 'Opts': {}}))
+        d2 = self.service._route_request(FakeRequest(
+            '/VolumeDriver.Create', {'Name': 'testvol', 'Opts': {}}))
+
+        self.assertEquals(len(jobs), 1)
+        jobs[0].callback(self.xylem_request('gluster', 'createvolume', {}))
+
+        result1 = yield d1
+        result2 = yield d2
+        self.assertEquals(result1['Err'], None)
+        self.assertEquals(result2['Err'], None)
+
+    def test_parse_mountinfo(self):
+        table = mounts.parse_mountinfo(MOUNTINFO)
+
+        self.assertEquals(table['/'], ('ext4', '/dev/sda1'))
+        self.assertEquals(
+            table['/tmp/docker-xylem-test/testvol'],
+            ('fuse.glusterfs', 'localhost:/testvol'))
+        self.assertIn('/tmp/docker-xylem-test/other vol', table)
+
+    def use_mountinfo(self, content):
+        """
+        Point the service mount index at a mountinfo file with `content`
+        """
+        path = self.mktemp()
+        with open(path, 'w') as f:
+            f.write(content)
+
+        self.service.mounts = mounts.MountTable(path)
+        self.addCleanup(self.service.mounts.close)
+        return path
+
+    @defer.inlineCallbacks
+    def test_unmount_uses_index(self):
+        """
+        Unmount should only fork for paths the mount index knows about
+        """
+        self.use_mountinfo(MOUNTINFO)
+        calls = []
+
+        def fork(*args, **kw):
+            calls.append(kw['args'])
+            return defer.succeed(("", "", 0))
+
+        self.service._fork = fork
+
+        result = yield self.service._route_request(FakeRequest(
+            '/VolumeDriver.Mount', {'Name': 'testvol', 'ID': 'one'}))
+        self.assertEquals(result['Err'], None)
+        self.assertEquals(calls, [])
+
+        result = yield self.service._route_request(FakeRequest(
+            '/VolumeDriver.Unmount', {'Name': 'testvol', 'ID': 'one'}))
+        self.assertEquals(result['Err'], None)
+        self.assertEquals(calls, [
+            ('/just/one/more/wont/hurt/testvol',),
+            ('/tmp/docker-xylem-test/testvol',),
+        ])
+
+    @defer.inlineCallbacks
+    def test_get_list_use_index(self):
+        """
+        Volumes mounted before the plugin started are reported by Get and
+        List, volumes which are no longer mounted are not
+        """
+        path = self.use_mountinfo(MOUNTINFO)
+
+        result = yield self.service._route_request(FakeRequest(
+            '/VolumeDriver.Get', {'Name': 'testvol'}))
+        self.assertEquals(result['Err'], None)
+        self.assertEquals(
+            result['Volume']['Mountpoint'], '/tmp/docker-xylem-test/testvol')
+
+        result = yield self.service._route_request(FakeRequest(
+            '/VolumeDriver.List', {}))
+        self.assertEquals(
+            sorted(v['Name'] for v in result['Volumes']),
+            ['other vol', 'testvol'])
+
+        with open(path, 'w') as f:
+            f.write(MOUNTINFO.splitlines()[0])
+        self.service.mounts.invalidate()
+
+        result = yield self.service._route_request(FakeRequest(
+            '/VolumeDriver.Get', {'Name': 'testvol'}))
+        self.assertEquals(result['Err'], 'No mounted volume')
+
+    @defer.inlineCallbacks
+    def test_state_journal(self):
+        """
+        A restarted service should know about volumes mounted before the
+        restart without remounting them
+        """
+        path = self.mktemp()
+        self.service.journal = journal.StateJournal(path)
+
+        for mount_id in ('one', 'two'):
+            yield self.service._route_request(FakeRequest(
+                '/VolumeDriver.Mount', {'Name': 'testvol', 'ID': mount_id}))
+        yield self.service._route_request(FakeRequest(
+            '/VolumeDriver.Mount', {'Name': 'othervol', 'ID': 'three'}))
+        yield self.service._route_request(FakeRequest(
+            '/VolumeDriver.Unmount', {'Name': 'othervol', 'ID': 'three'}))
+        self.service.journal.close()
+
+        service = DockerService({
+            'host': 'localhost',
+            'mount_path': '/tmp/docker-xylem-test',
+            'mountinfo': None,
+            'state_journal': path,
+            'catalog_refresh': 0
+        })
+        service._fork = lambda *a, **kw: self.fail('Unexpected fork')
+        service.start()
+        self.addCleanup(service.stop)
+
+        result = yield service._route_request(FakeRequest(
+            '/VolumeDriver.List', {}))
+        self.assertEquals(
+            [v['Name'] for v in result['Volumes']], ['testvol'])
+        self.assertEquals(service.mount_refs['testvol'], set(['one', 'two']))
+
+        # Compacted to a single line
+        service.journal.flush()
+        with open(path) as f:
+            self.assertEquals(len(f.readlines()), 1)
+
+        yield service._route_request(FakeRequest(
+            '/VolumeDriver.Mount', {'Name': 'testvol', 'ID': 'four'}))
+        self.assertEquals(
+            service.mount_refs['testvol'], set(['one', 'two', 'four']))
+
+    def test_state_journal_unmounted(self):
+        """
+        Volumes in the journal which are no longer mounted are dropped
+        """
+        path = self.mktemp()
+        state = journal.StateJournal(path)
+        state.record('testvol', '/tmp/docker-xylem-test/testvol', ['one'])
+        state.record('gonevol', '/tmp/docker-xylem-test/gonevol', ['two'])
+        state.close()
+
+        self.use_mountinfo(MOUNTINFO)
+        self.service.journal = journal.StateJournal(path)
+        self.service.start()
+        self.addCleanup(self.service.stop)
+        self.service.journal.flush()
+
+        self.assertEquals(
+            self.service.current.keys(), ['testvol'])
+        self.assertEquals(journal.StateJournal(path).load().keys(),
+                          ['testvol'])
+
+    @defer.inlineCallbacks
+    def test_catalog(self):
+        """
+        Get and List should report volumes known to xylem which are not
+        mounted here, and forget them once the catalog expires
+        """
+        clock = task.Clock()
+        self.service.catalog.clock = clock
+        self.service.catalog.interval = 60
+        self.service.catalog.start()
+        self.addCleanup(self.service.catalog.stop)
+
+        yield self.service._route_request(FakeRequest(
+            '/VolumeDriver.Mount', {'Name': 'testvol', 'ID': 'one'}))
+
+        result = yield self.service._route_request(FakeRequest(
+            '/VolumeDriver.Get', {'Name': 'othervol'}))
+        self.assertEquals(result['Err'], None)
+        self.assertEquals(result['Volume']['Mountpoint'], '')
+
+        result = yield self.service._route_request(FakeRequest(
+            '/VolumeDriver.List', {}))
+        self.assertEquals(
+            sorted((v['Name'], v['Mountpoint']) for v in result['Volumes']),
+            [('othervol', ''), ('testvol', '/tmp/docker-xylem-test/testvol')])
+
+        yield self.service._route_request(FakeRequest(
+            '/VolumeDriver.Create', {'Name': 'newvol', 'Opts': {}}))
+        yield self.service._route_request(FakeRequest(
+            '/VolumeDriver.Remove', {'Name': 'othervol'}))
+        self.assertEquals(
+            sorted(self.service.catalog.names()), ['newvol', 'testvol'])
+
+        # Refreshes keep failing until the catalog expires
+        self.service.xylem_request = lambda *a, **kw: defer.fail(
+            Exception('down'))
+        clock.advance(300)
+        self.assertEquals(self.service.catalog.names(), [])
+
+        result = yield self.service._route_request(FakeRequest(
+            '/VolumeDriver.Get', {'Name': 'newvol'}))
+        self.assertEquals(result['Err'], 'No mounted volume')
+
+    def test_xylem_async(self):
+        """
+        Async xylem requests submit the job and poll for its result
+        """
+        clock = task.Clock()
+        requests = []
+        polls = [{'result': None}, {'result': None}, {'result': {'id': 'x'}}]
+
+        def xylem_http(path, method='GET', data=None, timeout=60, **kw):
+            requests.append((clock.seconds(), method, path))
+            if method == 'POST':
+                return defer.succeed({'id': 'job1'})
+            return defer.succeed(polls.pop(0))
+
+        service = DockerService({
+            'host': 'localhost',
+            'mountinfo': None,
+            'state_journal': None,
+            'xylem_async': True
+        })
+        self.addCleanup(service.stop)
+        service.clock = clock
+        service._xylem_http = xylem_http
+
+        d = service.xylem_request('gluster', 'createvolume', {'name': 'x'})
+        clock.pump([0.5, 1, 2])
+
+        self.assertEquals(self.successResultOf(d), {'result': {'id': 'x'}})
+        self.assertEquals(requests, [
+            (0, 'POST', '/queues/gluster/createvolume'),
+            (0.5, 'GET', '/queues/gluster/result/job1'),
+            (1.5, 'GET', '/queues/gluster/result/job1'),
+            (3.5, 'GET', '/queues/gluster/result/job1'),
+        ])
+
+    def test_xylem_async_timeout(self):
+        clock = task.Clock()
+
+        def xylem_http(path, method='GET', data=None, timeout=60, **kw):
+            if method == 'POST':
+                return defer.succeed({'id': 'job1'})
+            return defer.succeed({'result': None})
+
+        service = DockerService({
+            'host': 'localhost',
+            'mountinfo': None,
+            'state_journal': None,
+            'xylem_async': True,
+            'xylem_async_timeout': 30
+        })
+        self.addCleanup(service.stop)
+        service.clock = clock
+        service._xylem_http = xylem_http
+
+        d = service.xylem_request('gluster', 'createvolume', {'name': 'x'})
+        clock.pump([5] * 10)
+
+        self.failureResultOf(d, utils.Timeout)
+
+    @defer.inlineCallbacks
+    def test_request_metrics(self):
+        """
+        Routed calls record their latency and errors
+        """
+        registry = metrics.REGISTRY
+        latency = registry.metrics['docker_xylem_request_seconds']
+        errors = registry.metrics['docker_xylem_request_errors_total']
+        endpoint = '/VolumeDriver.Get'
+
+        count = latency.count(endpoint=endpoint)
+        errs = errors.get(endpoint=endpoint)
+
+        yield self.service._route_request(FakeRequest(
+            endpoint, {'Name': 'missing'}))
+
+        self.assertEquals(latency.count(endpoint=endpoint), count + 1)
+        self.assertEquals(errors.get(endpoint=endpoint), errs + 1)
+        self.assertEquals(
+            registry.metrics['docker_xylem_mounted_volumes'].get(), 0)
+
+    def test_inflight_requests_gauge(self):
+        """
+        Coalesced calls each count as in flight until they are answered
+        """
+        gauge = metrics.REGISTRY.metrics['docker_xylem_inflight_requests']
+        pending = defer.Deferred()
+        self.service.xylem_request = lambda *a, **kw: pending
+
+        calls = [
+            self.service._route_request(FakeRequest(
+                '/VolumeDriver.Create', {'Name': 'testvol', 'Opts': {}}))
+            for i in range(3)
+        ]
+        self.assertEquals(len(self.service.inflight), 1)
+        self.assertEquals(gauge.get(), 3)
+
+        pending.callback(self.xylem_request('gluster', 'createvolume', {}))
+        for d in calls:
+            self.assertEquals(self.successResultOf(d), {'Err': None})
+        self.assertEquals(gauge.get(), 0)
+
+    def test_metrics_render(self):
+        registry = metrics.Registry()
+        registry.counter('c_total', 'A counter', ['path']).inc(path='/"x"')
+        registry.histogram('h_seconds', 'A histogram', buckets=(1, 5)
+                           ).observe(2)
+        registry.gauge('g', 'A gauge', lambda: 3)
+
+        self.assertEquals(registry.render(), '\n'.join([
+            '# HELP c_total A counter',
+            '# TYPE c_total counter',
+            'c_total{path="/\\"x\\""} 1.0',
+            '# HELP g A gauge',
+            '# TYPE g gauge',
+            'g 3.0',
+            '# HELP h_seconds A histogram',
+            '# TYPE h_seconds histogram',
+            'h_seconds_bucket{le="1.0"} 0.0',
+            'h_seconds_bucket{le="5.0"} 1.0',
+            'h_seconds_bucket{le="+Inf"} 1.0',
+            'h_seconds_sum 2.0',
+            'h_seconds_count 1.0',
+        ]) + '\n')
+
+    @defer.inlineCallbacks
+    def test_benchmark(self):
+        """
+        The benchmark drives a real service over a UNIX socket
+        """
+        bench = benchmark.Benchmark(
+            containers=4, concurrency=2, volumes=2, mount_latency=0,
+            xylem_latency=0, polls=1)
+
+        elapsed = yield bench.run()
+
+        self.assertTrue(elapsed > 0)
+        for endpoint in benchmark.ENDPOINTS:
+            self.assertEquals(len(bench.latencies[endpoint]), 4)
+            self.assertEquals(bench.errors[endpoint], 0)
+
+    def test_scheduler_limit(self):
+        """
+        The scheduler runs at most `concurrency` operations and starts
+        waiting unmounts before waiting mounts
+        """
+        scheduler = mounts.MountScheduler(concurrency=1)
+        running = []
+        started = []
+
+        def op(name):
+            started.append(name)
+            running.append(defer.Deferred())
+            return running[-1]
+
+        scheduler.limit(mounts.PRIORITY_MOUNT, op, 'mount1')
+        scheduler.limit(mounts.PRIORITY_MOUNT, op, 'mount2')
+        scheduler.limit(mounts.PRIORITY_UNMOUNT, op, 'umount')
+
+        self.assertEquals(started, ['mount1'])
+        self.assertEquals(scheduler.depth, 2)
+
+        running[0].callback(None)
+        running[1].callback(None)
+        self.assertEquals(started, ['mount1', 'umount', 'mount2'])
+        self.assertEquals(scheduler.depth, 0)
+
+        running[2].callback(None)
+        self.assertEquals(scheduler.running, 0)
+
+    def test_mount_unmount_serialized(self):
+        """
+        A Mount arriving while the volume is being unmounted waits for the
+        unmount and then mounts it again
+        """
+        forks = []
+
+        def fork(*args, **kw):
+            forks.append((args[0], defer.Deferred()))
+            return forks[-1][1]
+
+        self.service._fork = fork
+        self.service.mount_refs['testvol'] = set(['one'])
+        self.service.current['testvol'] = '/tmp/docker-xylem-test/testvol'
+
+        unmount = self.service._route_request(FakeRequest(
+            '/VolumeDriver.Unmount', {'Name': 'testvol', 'ID': 'one'}))
+        mount = self.service._route_request(FakeRequest(
+            '/VolumeDriver.Mount', {'Name': 'testvol', 'ID': 'two'}))
+
+        self.assertEquals([f[0] for f in forks], ['/bin/umount'] * 4)
+        self.assertEquals(self.service.scheduler.depth, 1)
+
+        forks[0][1].callback(("", "", 0))
+        self.assertEquals(self.service.scheduler.depth, 1)
+        for executable, d in forks[1:]:
+            self.assertEquals(executable, '/bin/umount')
+            d.callback(("", "", 0))
+
+        self.assertEquals(self.successResultOf(unmount)['Err'], None)
+        self.assertEquals(forks[-1][0], '/bin/mount')
+        forks[-1][1].callback(("", "", 0))
+
+        self.assertEquals(self.successResultOf(mount)['Err'], None)
+        self.assertEquals(self.service.mount_refs['testvol'], set(['two']))
+
+    @defer.inlineCallbacks
+    def test_unmount_parallel(self):
+        """
+        All mount paths are unmounted concurrently and every failure is
+        reported
+        """
+        forks = {}
+
+        def fork(executable, args=(), **kw):
+            forks[args[0]] = (kw['timeout'], defer.Deferred())
+            return forks[args[0]][1]
+
+        self.service._fork = fork
+        d = self.service._route_request(FakeRequest(
+            '/VolumeDriver.Unmount', {'Name': 'testvol', 'ID': 'one'}))
+
+        self.assertEquals(len(forks), 4)
+        self.assertEquals(set(t for t, f in forks.values()), set([30]))
+
+        forks['/some/old/path/testvol'][1].callback(("", "boom", 1))
+        forks['/just/one/more/wont/hurt/testvol'][1].errback(
+            Exception('killed'))
+        forks['/another/random/old/path/testvol'][1].callback((
+            "", "/another/random/old/path/testvol: not mounted", 32))
+        forks['/tmp/docker-xylem-test/testvol'][1].callback(("", "", 0))
+
+        result = yield d
+        self.assertEquals(
+            result['Err'],
+            '/just/one/more/wont/hurt/testvol: killed; '
+            '/some/old/path/testvol: boom')
+
+    def test_capped_buffer(self):
+        buf = utils.CappedBuffer(10)
+        buf.write('abc')
+        self.assertEquals(buf.getvalue(), 'abc')
+
+        buf.write('defghij')
+        self.assertEquals(buf.getvalue(), 'abcdefghij')
+
+        for c in 'klmnopqrstuvwxyz':
+            buf.write(c)
+        self.assertEquals(
+            buf.getvalue(), 'abcde\n[... 16 bytes truncated ...]\nvwxyz')
+
+    def test_body_receiver_max_size(self):
+        class Transport(object):
+            stopped = False
+
+            def stopProducing(self):
+                self.stopped = True
+
+        d = defer.Deferred()
+        receiver = utils.BodyReceiver(d, max_size=8)
+        receiver.makeConnection(Transport())
+        receiver.dataReceived('{"a": ')
+        receiver.dataReceived('"bcdef"}')
+        receiver.connectionLost(None)
+
+        self.failureResultOf(d, utils.BodyTooLarge)
+        self.assertTrue(receiver.transport.stopped)
+
+        d = defer.Deferred()
+        receiver = utils.BodyReceiver(d, max_size=8)
+        receiver.dataReceived('{"a": ')
+        receiver.dataReceived('1}')
+        receiver.connectionLost(None)
+        self.assertEquals(self.successResultOf(d).read(), '{"a": 1}')
+
+    @defer.inlineCallbacks
+    def test_mount_helper(self):
+        """
+        The mount helper runs allowed commands and reports their output,
+        exit code and timeouts like fork does
+        """
+        helper = utils.MountHelper(allowed=('/bin/sh',))
+        helper.start()
+        self.addCleanup(helper.stop)
+
+        out, err, code = yield helper.run(
+            '/bin/sh', args=('-c', 'echo out; echo err >&2; exit 3'))
+        self.assertEquals((out, err, code), ('out\n', 'err\n', 3))
+
+        results = yield defer.DeferredList([
+            helper.run('/bin/sh', args=('-c', 'exec sleep 5'), timeout=0.1),
+            helper.run('/bin/umount', args=('/',)),
+            helper.run('/bin/sh', args=('-c', 'exit 0')),
+        ], consumeErrors=True)
+
+        self.assertFalse(results[0][0])
+        results[0][1].trap(error.ProcessTerminated)
+        self.assertFalse(results[1][0])
+        self.assertIn('may not be run', str(results[1][1].value))
+        self.assertEquals(results[2], (True, ('', '', 0)))
+
+        out, err, code = yield helper.run(
+            '/bin/sh', args=('-c', 'echo $GREETING; pwd'),
+            env={'GREETING': 'hello'}, path='/')
+        self.assertEquals(out, 'hello\n/\n')
+
+    @defer.inlineCallbacks
+    def test_mount_helper_stop(self):
+        """
+        Stopping the helper kills it if commands are still running after
+        the stop timeout
+        """
+        helper = utils.MountHelper(allowed=('/bin/sh',), stop_timeout=0.1)
+        helper.start()
+
+        d = helper.run('/bin/sh', args=('-c', 'exec sleep 30'))
+        yield helper.stop()
+        self.assertFalse(helper.running)
+        yield self.assertFailure(d, Exception)
+
+    def test_parse_hosts(self):
+        self.assertEquals(
+            endpoints.parse_hosts('xylem1', 7701), [('xylem1', 7701)])
+        self.assertEquals(
+            endpoints.parse_hosts(['xylem1', 'xylem2:8000'], 7701),
+            [('xylem1', 7701), ('xylem2', 8000)])
+        self.assertEquals(
+            endpoints.parse_hosts(['[2001:db8::1]', '[::1]:8000'], 7701),
+            [('2001:db8::1', 7701), ('::1', 8000)])
+        self.assertEquals(
+            endpoints.Endpoint('::1', 8000, None).url('/'),
+            'http://[::1]:8000/')
+
+        for host in ('2001:db8::1', '[::1', '[::1]8000'):
+            self.assertRaises(
+                ValueError, endpoints.parse_hosts, host, 7701)
+
+    def test_endpoint_choice(self):
+        """
+        Requests go to the healthy endpoint with the lowest latency
+        """
+        clock = task.Clock()
+        probes = {}
+
+        def probe(endpoint):
+            probes[endpoint.host] = defer.Deferred()
+            return probes[endpoint.host]
+
+        xylem = endpoints.EndpointSet(
+            [('a', 1), ('b', 1), ('c', 1)], probe, clock=clock)
+        xylem.start()
+        self.addCleanup(xylem.stop)
+
+        clock.advance(0.2)
+        probes['b'].callback(None)
+        clock.advance(0.1)
+        probes['c'].callback(None)
+        probes['a'].errback(Exception('down'))
+
+        self.assertEquals(xylem.choose().host, 'b')
+
+        # Slow responses move traffic elsewhere
+        xylem.record(xylem.endpoints[1], 1)
+        xylem.record(xylem.endpoints[1], 1)
+        self.assertEquals(xylem.choose().host, 'c')
+
+        # Recovered endpoints come back into use
+        clock.advance(10)
+        probes['a'].callback(None)
+        probes['b'].callback(None)
+        probes['c'].errback(Exception('down'))
+        self.assertEquals(xylem.choose().host, 'a')
+
+    def test_circuit_breaker(self):
+        """
+        An endpoint failing repeatedly is skipped until a trial request to it
+        succeeds
+        """
+        clock = task.Clock()
+        xylem = endpoints.EndpointSet(
+            [('a', 1)], None, breaker_threshold=3, breaker_reset=30,
+            clock=clock)
+        a = xylem.endpoints[0]
+
+        for i in range(3):
+            self.assertEquals(xylem.choose(), a)
+            self.failureResultOf(
+                xylem.call(lambda e: defer.fail(Exception('down')), a))
+        self.assertRaises(endpoints.CircuitOpen, xylem.choose)
+
+        # One trial request at a time once the reset timeout passes
+        clock.advance(30)
+        self.assertEquals(xylem.choose(), a)
+        trial = defer.Deferred()
+        d = xylem.call(lambda e: trial, a)
+        self.assertRaises(endpoints.CircuitOpen, xylem.choose)
+
+        trial.errback(Exception('still down'))
+        self.failureResultOf(d)
+        self.assertRaises(endpoints.CircuitOpen, xylem.choose)
+
+        clock.advance(30)
+        xylem.call(lambda e: defer.succeed(None), a)
+        self.assertEquals(a.breaker.state, a.breaker.CLOSED)
+        self.assertEquals(xylem.choose(), a)
+
+    def test_circuit_open_fails_fast(self):
+        """
+        Xylem requests fail without waiting while the circuit is open
+        """
+        breaker = self.service.xylem.endpoints[0].breaker
+        for i in range(breaker.threshold):
+            breaker.failure()
+        self.patch(utils, 'HTTPRequest', lambda **kw: self.fail('Called'))
+
+        d = self.service._xylem_http('/queues/gluster/wait/createvolume')
+        self.failureResultOf(d, endpoints.CircuitOpen)
+
+        # And Docker is answered with the error straight away
+        del self.service.xylem_request
+        request = DummyRequest([''])
+        request.path = '/VolumeDriver.Create'
+        request.content = StringIO(json.dumps({'Name': 'testvol'}))
+        self.service.render_POST(request)
+
+        self.assertEquals(request.finished, 1)
+        self.assertEquals(json.loads(''.join(request.written)), {
+            'Err': 'Circuit open for every xylem endpoint'})
+
+    def test_xylem_requests_per_host(self):
+        """
+        No more than http_pool_size requests to a xylem host run at once,
+        and time spent waiting for one to finish counts against the timeout
+        """
+        clock = task.Clock()
+        sent = []
+
+        class FakeHTTPRequest(object):
+            def __init__(self, **kw):
+                pass
+
+            def getJson(self, url, **kw):
+                sent.append(defer.Deferred())
+                return sent[-1]
+
+        self.patch(utils, 'HTTPRequest', FakeHTTPRequest)
+        service = DockerService({
+            'host': 'localhost',
+            'mountinfo': None,
+            'state_journal': None,
+            'http_pool_size': 2
+        })
+        self.addCleanup(service.stop)
+        service.clock = clock
+
+        calls = [service._xylem_http('/queues/gluster/result/job1',
+                                     timeout=10)
+                 for i in range(4)]
+        self.assertEquals(len(sent), 2)
+
+        sent[0].callback({'result': None})
+        self.assertEquals(self.successResultOf(calls[0]), {'result': None})
+        self.assertEquals(len(sent), 3)
+
+        clock.advance(10)
+        for d in calls[1:]:
+            self.failureResultOf(d, utils.Timeout)
+
+        # The request which timed out waiting is never sent
+        sent[1].callback({'result': None})
+        self.assertEquals(len(sent), 3)
+
+    def test_xylem_job_waits_not_limited(self):
+        """
+        Creates waiting on xylem jobs all run at once, however many
+        requests each host is limited to
+        """
+        sent = []
+
+        class FakeHTTPRequest(object):
+            def __init__(self, **kw):
+                pass
+
+            def getJson(self, url, **kw):
+                sent.append(defer.Deferred())
+                return sent[-1]
+
+        self.patch(utils, 'HTTPRequest', FakeHTTPRequest)
+        del self.service.xylem_request
+        self.assertEquals(self.service.xylem.endpoints[0].slots.limit, 4)
+
+        calls = [
+            self.service._route_request(FakeRequest(
+                '/VolumeDriver.Create', {'Name': 'vol%s' % i}))
+            for i in range(5)
+        ]
+        self.assertEquals(len(sent), 5)
+
+        for d in sent:
+            d.callback({'result': {'running': True, 'id': 'x'}})
+        for d in calls:
+            self.assertEquals(self.successResultOf(d), {'Err': None})
+
+    def test_adaptive_timeout(self):
+        timeouts = endpoints.AdaptiveTimeout(
+            percentile=0.9, factor=2, minimum=1, min_samples=10)
+        self.assertEquals(timeouts.timeout('create', 60), 60)
+
+        for i in range(10):
+            timeouts.observe('create', i + 1)
+        self.assertEquals(timeouts.timeout('create', 60), 20)
+        self.assertEquals(timeouts.timeout('create', 15), 15)
+        self.assertEquals(timeouts.timeout('list', 60), 60)
+
+        for i in range(200):
+            timeouts.observe('create', 0.1)
+        self.assertEquals(timeouts.timeout('create', 60), 1)
+
+    def test_xylem_wait_timeout_not_adapted(self):
+        """
+        Waiting for a xylem job always allows the full timeout, while other
+        requests get one adapted to their recent latency
+        """
+        timeouts = []
+
+        class FakeHTTPRequest(object):
+            def __init__(self, timeout=60, **kw):
+                timeouts.append(timeout)
+
+            def getJson(self, url, **kw):
+                return defer.succeed({'result': {'id': 'x'}})
+
+        self.patch(utils, 'HTTPRequest', FakeHTTPRequest)
+        service = DockerService({
+            'host': 'localhost',
+            'mountinfo': None,
+            'state_journal': None
+        })
+        self.addCleanup(service.stop)
+        service.clock = task.Clock()
+        for kind in ('/queues/gluster/wait/createvolume',
+                     '/queues/gluster/result'):
+            for i in range(50):
+                service.xylem_timeouts.observe(kind, 0.1)
+
+        d = service.xylem_request('gluster', 'createvolume', {'name': 'x'})
+        self.assertEquals(self.successResultOf(d), {'result': {'id': 'x'}})
+        d = service._xylem_http('/queues/gluster/result/job1',
+                                kind='/queues/gluster/result')
+        self.successResultOf(d)
+        self.assertEquals(timeouts, [60, 5])
+
+        # Nor are its latencies recorded
+        self.assertEquals(len(service.xylem_timeouts.latencies[
+            '/queues/gluster/wait/createvolume']), 50)
+
+    def test_retry_policy(self):
+        clock = task.Clock()
+        policy = utils.RetryPolicy(
+            utils.transient_http_error, budget=10, clock=clock)
+        attempts = []
+
+        def flaky(e):
+            attempts.append(clock.seconds())
+            if len(attempts) < 3:
+                return defer.fail(e)
+            return defer.succeed('done')
+
+        d = policy.run(flaky, error.ConnectionLost())
+        clock.pump([0.5] * 4)
+        self.assertEquals(self.successResultOf(d), 'done')
+        self.assertEquals(len(attempts), 3)
+
+        # Fatal errors are not retried
+        del attempts[:]
+        d = policy.run(flaky, ValueError('bad json'))
+        self.failureResultOf(d, ValueError)
+        self.assertEquals(len(attempts), 1)
+
+        # Nor are retries started after the budget is spent
+        del attempts[:]
+
+        def timeout():
+            attempts.append(clock.seconds())
+            return defer.fail(utils.Timeout())
+
+        d = policy.run(timeout)
+        clock.pump([1] * 20)
+        self.failureResultOf(d, utils.Timeout)
+        self.assertTrue(len(attempts) > 1)
+        self.assertTrue(attempts[-1] - attempts[0] <= 10)
+
+    @defer.inlineCallbacks
+    def test_create_idempotency_key(self):
+        """
+        A retried Create sends the same idempotency key each time
+        """
+        sent = []
+
+        def xylem_http(path, method='GET', data=None, timeout=60, **kw):
+            sent.append(kw['idempotency_key'])
+            if len(sent) == 1:
+                return defer.fail(error.ConnectionLost())
+            return defer.succeed({'result': {'running': True, 'id': 'x'}})
+
+        service = DockerService({
+            'host': 'localhost',
+            'mountinfo': None,
+            'state_journal': None,
+            'catalog_refresh': 0,
+        })
+        service._xylem_http = xylem_http
+        service.xylem_retry.initial = 0.001
+
+        result = yield service._route_request(FakeRequest(
+            '/VolumeDriver.Create', {'Name': 'testvol', 'Opts': {}}))
+        self.assertEquals(result['Err'], None)
+        self.assertEquals(len(sent), 2)
+        self.assertEquals(sent[0], sent[1])
+        self.assertTrue(sent[0])
+
+    def test_mount_retry(self):
+        """
+        Mounts which fail while gluster is unavailable are retried
+        """
+        clock = task.Clock()
+        results = [
+            ("", "0-glusterfs: connection to 10.0.0.1:24007 failed "
+                 "(Connection refused)", 32),
+            ("", "0-mgmt: failed to fetch volume file (key:/testvol)", 32),
+            ("", "", 0),
+        ]
+
+        def fork(*a, **kw):
+            return defer.succeed(results.pop(0))
+
+        self.service._fork = fork
+        self.service.mount_retry.clock = clock
+
+        d = self.service._route_request(FakeRequest(
+            '/VolumeDriver.Mount', {'Name': 'testvol', 'ID': 'abc'}))
+        clock.pump([1] * 5)
+        self.assertEquals(self.successResultOf(d)['Err'], None)
+        self.assertEquals(results, [])
+
+        # Other failures are not, even with the same exit code
+        for result in [("", "Mount failed. Please check the log file", 32),
+                       ("", "only root can do that", 1)]:
+            results[:] = [result, ("", "", 0)]
+            d = self.service._route_request(FakeRequest(
+                '/VolumeDriver.Mount', {'Name': 'other', 'ID': 'abc'}))
+            self.assertIn('MountError', self.successResultOf(d)['Err'])
+            self.assertEquals(results, [("", "", 0)])
+
+    def test_mount_prober(self):
+        """
+        Mounts whose stat hangs or fails like a dead FUSE mount are stale
+        until they respond again
+        """
+        clock = task.Clock()
+        stats = {}
+        found = []
+
+        def stat(path):
+            stats[path] = defer.Deferred()
+            return stats[path]
+
+        prober = mounts.MountProber(
+            lambda: [('a', '/a'), ('b', '/b'), ('c', '/c')], stat,
+            on_stale=lambda name, path: found.append(name),
+            interval=5, clock=clock)
+        prober.start()
+        self.addCleanup(prober.stop)
+
+        clock.advance(5)
+        stats.pop('/a').callback(None)
+        stats.pop('/b').errback(OSError(107, 'Not connected'))
+        clock.advance(2)
+        stats.pop('/c').errback(utils.Timeout('stat took too long'))
+        self.assertEquals(found, ['b', 'c'])
+        self.assertFalse(prober.is_stale('/a'))
+        self.assertTrue(prober.is_stale('/b'))
+        self.assertTrue(prober.is_stale('/c'))
+
+        # Paths recover once a stat returns in time
+        clock.advance(3)
+        self.assertEquals(sorted(stats), ['/a', '/b', '/c'])
+        stats.pop('/c').callback(None)
+        self.assertFalse(prober.is_stale('/c'))
+        self.assertEquals(
+            prober.summary(), [{'name': 'b', 'path': '/b', 'seconds': 5}])
+
+    @defer.inlineCallbacks
+    def test_stale_mount(self):
+        """
+        Stale mounts are reported by Path, Get and health, and remounted if
+        remount_stale is set
+        """
+        forks = []
+
+        def fork(executable, args=(), **kw):
+            forks.append((executable, args))
+            return defer.succeed(("", "", 0))
+
+        self.service._fork = fork
+        yield self.service._route_request(FakeRequest(
+            '/VolumeDriver.Mount', {'Name': 'testvol', 'ID': 'abc'}))
+        path = self.service.current['testvol']
+
+        self.service.prober._mark_stale('testvol', path, 'test')
+        result = yield self.service._route_request(FakeRequest(
+            '/VolumeDriver.Path', {'Name': 'testvol'}))
+        self.assertEquals(result['Err'], 'Mount of volume testvol is stale')
+        result = yield self.service._route_request(FakeRequest(
+            '/VolumeDriver.Get', {'Name': 'testvol'}))
+        self.assertEquals(result['Volume']['Status'], {'Stale': True})
+
+        health = self.service.health()
+        self.assertFalse(health['healthy'])
+        self.assertEquals(health['stale'][0]['path'], path)
+
+        request = DummyRequest([''])
+        body = HealthResource(self.service).render_GET(request)
+        self.assertEquals(request.responseCode, 503)
+        self.assertEquals(json.loads(body)['mounts'], 1)
+
+        # Remounts wait their turn with other mounts and umounts
+        del forks[:]
+        scheduler = self.service.scheduler
+        scheduler.running = scheduler.concurrency
+        self.service.remount_stale = True
+        self.service.prober.forget(path)
+        self.service.prober._mark_stale('testvol', path, 'test')
+        self.assertEquals(forks, [])
+        self.assertEquals(scheduler.depth, 1)
+
+        scheduler._release()
+        self.assertEquals(forks, [
+            ('/bin/umount', ('-l', path)),
+            ('/bin/mount', ('-t', 'glusterfs', 'localhost:/testvol', path)),
+        ])
+        self.assertEquals(scheduler.running, scheduler.concurrency - 1)
+        self.assertTrue(self.service.health()['healthy'])
+
+    @defer.inlineCallbacks
+    def test_filesystem_executor(self):
+        executor = fs.FilesystemExecutor(max_threads=2, timeout=5)
+        self.addCleanup(executor.stop)
+        path = os.path.join(self.mktemp(), 'a', 'b')
+
+        yield executor.makedirs(path)
+        yield executor.makedirs(path)
+        stat = yield executor.stat(path)
+        self.assertTrue(stat.st_mode)
+        yield executor.run(os.rmdir, path)
+        yield self.assertFailure(executor.stat(path), OSError)
+
+    @defer.inlineCallbacks
+    def test_filesystem_executor_deadline(self):
+        """
+        Calls which hang fail after their deadline, and the threads stuck
+        in them are replaced so calls on healthy paths still run
+        """
+        clock = task.Clock()
+        executor = fs.FilesystemExecutor(max_threads=2, timeout=5, clock=clock)
+        self.addCleanup(executor.stop)
+        blocked = threading.Event()
+        self.addCleanup(blocked.set)
+        started = threading.Semaphore(0)
+
+        def hang(path):
+            started.release()
+            blocked.wait()
+
+        hung = [executor.run(hang, '/hung/%s' % i) for i in range(2)]
+        for i in range(2):
+            started.acquire()
+        clock.advance(5)
+        for d in hung:
+            self.failureResultOf(d, utils.Timeout)
+        self.assertEquals(executor.hung_threads, 2)
+        self.assertEquals(executor.threads, 0)
+
+        # A hung path is not tried again while its call is stuck
+        self.failureResultOf(executor.run(hang, '/hung/0'), utils.Timeout)
+
+        path = os.path.join(self.mktemp(), 'healthy')
+        yield executor.makedirs(path)
+        self.assertTrue(os.path.isdir(path))
+
+    @defer.inlineCallbacks
+    def test_volume_options(self):
+        """
+        Create Opts are sent to xylem and used as mount options, over the
+        configured defaults
+        """
+        jobs = []
+        forks = []
+
+        def xylem_request(queue, call, data, **kw):
+            jobs.append(data)
+            return self.xylem_request(queue, call, data)
+
+        def fork(executable, args=(), **kw):
+            forks.append(args)
+            return defer.succeed(("", "", 0))
+
+        self.service.xylem_request = xylem_request
+        self.service._fork = fork
+        self.service.volume_defaults = options.parse_options({
+            'replica': '2', 'entry-timeout': '1'})
+
+        result = yield self.service._route_request(FakeRequest(
+            '/VolumeDriver.Create', {'Name': 'testvol', 'Opts': {
+                'transport': 'rdma',
+                'attribute-timeout': '600',
+                'read-ahead': '16',
+            }}))
+        self.assertEquals(result['Err'], None)
+        self.assertEquals(
+            jobs, [{'name': 'testvol', 'replica': 2, 'transport': 'rdma'}])
+
+        yield self.service._route_request(FakeRequest(
+            '/VolumeDriver.Mount', {'Name': 'testvol', 'ID': 'abc'}))
+        self.assertEquals(forks, [(
+            '-t', 'glusterfs', '-o',
+            'attribute-timeout=600,entry-timeout=1,'
+            'xlator-option=*read-ahead.page-count=16',
+            'localhost:/testvol', '/tmp/docker-xylem-test/testvol')])
+
+        yield self.service._route_request(FakeRequest(
+            '/VolumeDriver.Remove', {'Name': 'testvol'}))
+        self.assertEquals(
+            self.service.mount_options('testvol'), ['entry-timeout=1'])
+
+    def test_volume_options_seconds(self):
+        self.assertEquals(
+            options.parse_options({
+                'entry-timeout': ' 1e1 ', 'attribute-timeout': '0.5'}),
+            {'entry-timeout': 10, 'attribute-timeout': 0.5})
+
+    @defer.inlineCallbacks
+    def test_volume_options_journal(self):
+        """
+        Volume options survive a restart, until the volume is removed
+        """
+        path = self.mktemp()
+        self.service.options_journal = journal.OptionsJournal(path)
+
+        for name in ('testvol', 'othervol'):
+            yield self.service._route_request(FakeRequest(
+                '/VolumeDriver.Create', {'Name': name, 'Opts': {
+                    'direct-io-mode': 'enable'}}))
+        yield self.service._route_request(FakeRequest(
+            '/VolumeDriver.Remove', {'Name': 'othervol'}))
+        self.service.options_journal.close()
+
+        service = DockerService({
+            'host': 'localhost',
+            'mount_path': '/tmp/docker-xylem-test',
+            'mountinfo': None,
+            'state_journal': os.path.join(self.mktemp(), 'state'),
+            'catalog_refresh': 0
+        })
+        service.options_journal = journal.OptionsJournal(path)
+        service.start()
+        self.addCleanup(service.stop)
+
+        self.assertEquals(
+            service.mount_options('testvol'), ['direct-io-mode=enable'])
+        self.assertEquals(service.mount_options('othervol'), [])
+
+    def test_create_coalesces_same_options(self):
+        """
+        Concurrent Creates share a xylem job only if their options match
+        """
+        jobs = []
+        pending = []
+
+        def xylem_request(queue, call, data, **kw):
+            jobs.append(data)
+            pending.append(defer.Deferred())
+            return pending[-1]
+
+        self.service.xylem_request = xylem_request
+
+        calls = [
+            self.service._route_request(FakeRequest(
+                '/VolumeDriver.Create', {'Name': 'testvol', 'Opts': opts}))
+            for opts in ({'replica': '2'}, {'replica': '2'}, {'replica': '3'})
+        ]
+        self.assertEquals(
+            [job['replica'] for job in jobs], [2, 3])
+
+        for d in pending:
+            d.callback(self.xylem_request('gluster', 'createvolume', {}))
+        for d in calls:
+            self.assertEquals(self.successResultOf(d), {'Err': None})
+
+    @defer.inlineCallbacks
+    def test_invalid_volume_options(self):
+        for opts, err in [
+            ({'size': '10G'}, 'Unknown volume option size'),
+            ({'replica': '0'}, 'Invalid value for replica, '
+                               'must be at least 1'),
+            ({'direct-io-mode': 'on'}, 'Invalid value for direct-io-mode, '
+                                       'must be one of enable, disable'),
+            ({'entry-timeout': 'nan'}, 'Invalid value for entry-timeout, '
+                                       'must be a number of seconds'),
+            ({'entry-timeout': 'inf'}, 'Invalid value for entry-timeout, '
+                                       'must be a number of seconds'),
+        ]:
+            result = yield self.service._route_request(FakeRequest(
+                '/VolumeDriver.Create', {'Name': 'testvol', 'Opts': opts}))
+            self.assertEquals(result['Err'], err)
+
+    @defer.inlineCallbacks
+    def test_create_cache(self):
+        """
+        Repeat Creates are answered without xylem until the volume is
+        removed, fails to mount or the cache entry expires
+        """
+        clock = task.Clock()
+        jobs = []
+
+        def xylem_request(queue, call, data, **kw):
+            jobs.append(data['name'])
+            return self.xylem_request(queue, call, data)
+
+        def create(opts={}):
+            return self.service._route_request(FakeRequest(
+                '/VolumeDriver.Create', {'Name': 'testvol', 'Opts': opts}))
+
+        self.service.xylem_request = xylem_request
+        self.service.created.clock = clock
+
+        yield create()
+        yield create()
+        self.assertEquals(len(jobs), 1)
+
+        # Different options are sent to xylem
+        yield create({'replica': '3'})
+        self.assertEquals(len(jobs), 2)
+
+        yield self.service._route_request(FakeRequest(
+            '/VolumeDriver.Remove', {'Name': 'testvol'}))
+        yield create()
+        self.assertEquals(len(jobs), 3)
+
+        self.service._fork = lambda *a, **kw: defer.succeed(("", "boom", 1))
+        yield self.service._route_request(FakeRequest(
+            '/VolumeDriver.Mount', {'Name': 'testvol', 'ID': 'abc'}))
+        yield create()
+        self.assertEquals(len(jobs), 4)
+
+        clock.advance(300)
+        yield create()
+        self.assertEquals(len(jobs), 5)
+
+        self.assertEquals(self.service.created.hits, 1)
+        self.assertEquals(self.service.created.misses, 5)
+
+    @defer.inlineCallbacks
+    def test_mount_backup_servers(self):
+        """
+        Extra gluster servers are passed to mount as backup volfile servers
+        """
+        calls = []
+
+        def fork(executable, args=(), **kw):
+            calls.append(args)
+            return defer.succeed(("", "", 0))
+
+        service = DockerService({
+            'host': ['xylem1', 'xylem2:7702'],
+            'mount_path': '/tmp/docker-xylem-test',
+            'mountinfo': None,
+            'state_journal': None,
+        })
+        service._fork = fork
+
+        result = yield service._route_request(FakeRequest(
+            '/VolumeDriver.Mount', {'Name': 'testvol', 'ID': 'one'}))
+        self.assertEquals(result['Err'], None)
+        self.assertEquals(calls, [(
+            '-t', 'glusterfs', '-o', 'backup-volfile-servers=xylem2',
+            'xylem1:/testvol', '/tmp/docker-xylem-test/testvol')])
+
+    def test_warm_mounts(self):
+        """
+        Volumes stay mounted for the grace period after their last Unmount
+        and are reused without forking if mounted again
+        """
+        clock = task.Clock()
+        calls = []
+
+        def fork(executable, args=(), **kw):
+            calls.append(executable)
+            return defer.succeed(("", "", 0))
+
+        self.service._fork = fork
+        self.service.warm = mounts.WarmMounts(
+            self.service.expire_warm, grace=30, limit=2, clock=clock)
+
+        def call(endpoint, name, mount_id):
+            return self.successResultOf(self.service._route_request(
+                FakeRequest(endpoint, {'Name': name, 'ID': mount_id})))
+
+        call('/VolumeDriver.Mount', 'testvol', 'one')
+        call('/VolumeDriver.Unmount', 'testvol', 'one')
+        self.assertEquals(calls, ['/bin/mount'])
+        self.assertIn('testvol', self.service.warm)
+        self.assertIn('testvol', self.service.current)
+
+        clock.advance(20)
+        result = call('/VolumeDriver.Mount', 'testvol', 'two')
+        self.assertEquals(result['Err'], None)
+        self.assertEquals(calls, ['/bin/mount'])
+        self.assertNotIn('testvol', self.service.warm)
+
+        call('/VolumeDriver.Unmount', 'testvol', 'two')
+        clock.advance(30)
+        self.assertEquals(calls, ['/bin/mount'] + ['/bin/umount'] * 4)
+        self.assertNotIn('testvol', self.service.current)
+
+        # A warm mount which went stale is detached and mounted again
+        del calls[:]
+        call('/VolumeDriver.Mount', 'testvol', 'three')
+        call('/VolumeDriver.Unmount', 'testvol', 'three')
+        path = self.service.current['testvol']
+        self.service.prober._mark_stale('testvol', path, 'test')
+
+        result = call('/VolumeDriver.Mount', 'testvol', 'four')
+        self.assertEquals(result['Err'], None)
+        self.assertEquals(
+            calls, ['/bin/mount', '/bin/umount', '/bin/mount'])
+        self.assertFalse(self.service.prober.is_stale(path))
+
+    def test_warm_mounts_lru(self):
+        """
+        The least recently used warm volume is unmounted when there are
+        too many
+        """
+        expired = []
+        clock = task.Clock()
+        warm = mounts.WarmMounts(
+            expired.append, grace=30, limit=2, clock=clock)
+
+        warm.add('a')
+        warm.add('b')
+        warm.add('a')
+        warm.add('c')
+
+        self.assertEquals(expired, ['b'])
+        self.assertEquals(len(warm), 2)
+        self.assertTrue(warm.take('a'))
+
+        clock.advance(30)
+        self.assertEquals(expired, ['b', 'c'])
+        self.assertEquals(len(warm), 0)
+
+    def test_log_policy(self):
+        policy = logs.RequestLogPolicy(
+            levels={'VolumeDriver.Mount': 'warn', 'Plugin.Activate': 'debug'},
+            min_level='info', sample_rate=0.25)
+
+        self.assertEquals(policy.level_for('/VolumeDriver.Mount'), 'warn')
+        self.assertEquals(policy.level_for('/VolumeDriver.Create'), 'info')
+        self.assertEquals(policy.level_for('/Plugin.Activate'), None)
+
+        levels = [policy.level_for('/VolumeDriver.Get') for i in range(8)]
+        self.assertEquals(levels, ['info', None, None, None] * 2)
+
+        policy = logs.RequestLogPolicy(sample_rate=0)
+        self.assertEquals(policy.level_for('/VolumeDriver.List'), None)
+
+        for kw in [{'level': 'warning'}, {'min_level': 'INFO'},
+                   {'levels': {'VolumeDriver.Mount': 'verbose'}}]:
+            self.assertRaises(ValueError, logs.RequestLogPolicy, **kw)
+
+    @defer.inlineCallbacks
+    def test_lazy_request_logging(self):
+        """
+        Request payloads are only serialised for calls which are logged
+        """
+        dumped = []
+        LazyJSON = logs.LazyJSON
+
+        class Payload(LazyJSON):
+            def __str__(self):
+                dumped.append(self.data)
+                return LazyJSON.__str__(self)
+
+        self.patch(logs, 'LazyJSON', Payload)
+        events = []
+        self.service.log = Logger()
+        self.service.log.info = lambda fmt, **kw: events.append(
+            fmt.format(**kw))
+        self.service.log_policy = logs.RequestLogPolicy(sample_rate=0)
+
+        yield self.service._route_request(FakeRequest(
+            '/VolumeDriver.Get', {'Name': 'testvol'}))
+        yield self.service._route_request(FakeRequest(
+            '/VolumeDriver.Path', {'Name': 'testvol'}))
+        self.assertEquals(dumped, [])
+
+        yield self.service._route_request(FakeRequest(
+            '/VolumeDriver.Remove', {'Name': 'testvol'}))
+        self.assertEquals(dumped, [{'Name': 'testvol'}])
+        self.assertIn(
+            '/VolumeDriver.Remove called. data={"Name": "testvol"}', events)
+
+    def test_buffered_log_writer(self):
+        path = self.mktemp()
+        writer = logs.BufferedLogWriter(open(path, 'w'))
+        writer({'message': ('hello',), 'isError': 0, 'time': 0,
+                'system': 'test'})
+        writer({'message': ('world',), 'isError': 0, 'time': 0,
+                'system': 'test'})
+        writer.stop()
+
+        with open(path) as f:
+            lines = f.readlines()
+        self.assertEquals(len(lines), 2)
+        self.assertTrue(lines[0].endswith(' [test] hello\n'))
+        self.assertTrue(lines[1].endswith(' [test] world\n'))
+
+    def test_state_journal_new_directory(self):
+        """
+        Starting with a journal in a directory which does not exist yet
+        creates it
+        """
+        path = os.path.join(self.mktemp(), 'volumes', '.state')
+        self.service.journal = journal.StateJournal(path)
+        self.service.start()
+        self.addCleanup(self.service.stop)
+        self.service.journal.flush()
+
+        self.assertTrue(os.path.exists(path))
+
+    @defer.inlineCallbacks
+    def test_request_trace(self):
+        """
+        Each Docker call is exported as a trace holding a span for every
+        mount it forks
+        """
+        traces = []
+        self.service.tracer = tracing.Tracer([traces.append])
+
+        yield self.service._route_request(FakeRequest(
+            '/VolumeDriver.Mount', {'Name': 'testvol', 'ID': 'abc'}))
+
+        self.assertEquals(len(traces), 1)
+        self.assertEquals(traces[0]['name'], '/VolumeDriver.Mount')
+        self.assertEquals(traces[0]['error'], None)
+        self.assertEquals(len(traces[0]['trace_id']), 32)
+        self.assertEquals(
+            [s['name'] for s in traces[0]['spans']], ['makedirs', 'mount'])
+
+    def test_trace_header(self):
+        """
+        Requests to xylem carry the id of the trace they belong to
+        """
+        sent = []
+
+        class FakeHTTPRequest(object):
+            def __init__(self, **kw):
+                pass
+
+            def getJson(self, url, method='GET', headers={}, data=None):
+                sent.append(headers)
+                return defer.succeed({'result': {}})
+
+        self.patch(utils, 'HTTPRequest', FakeHTTPRequest)
+        trace = tracing.Tracer([lambda t: None]).trace('/VolumeDriver.Create')
+
+        d = self.service._xylem_http('/queues/gluster/wait/createvolume',
+                                     method='POST', trace=trace)
+        self.assertEquals(self.successResultOf(d), {'result': {}})
+        self.assertEquals(sent, [{'X-Trace-Id': [trace.id]}])
+        self.assertEquals(trace.spans[0].name, 'http_request')
+
+    def test_trace_file_exporter(self):
+        path = self.mktemp()
+        exporter = tracing.FileExporter(path)
+        exporter({'trace_id': 'abc', 'spans': []})
+        exporter.stop()
+
+        with open(path) as f:
+            self.assertEquals(
+                json.loads(f.read()), {'trace_id': 'abc', 'spans': []})
+
+    def test_stall_monitor(self):
+        """
+        Late reactor ticks are measured, and the reactor's stack is reported
+        once while it is stalled
+        """
+        now = [0]
+        monitor = diagnostics.StallMonitor(
+            threshold=0.5, interval=0.1, clock=task.Clock(),
+            now=lambda: now[0])
+        monitor.thread_id = threading.current_thread().ident
+        monitor.last_tick = 0
+
+        now[0] = 0.15
+        self.assertAlmostEqual(monitor.tick(), 0.05)
+        self.assertEquals(monitor.check(), None)
+
+        now[0] = 1
+        stack = monitor.check()
+        self.assertIn('test_stall_monitor', stack)
+        self.assertEquals(monitor.check(), None)
+
+        self.assertAlmostEqual(monitor.tick(), 0.75)
+        self.assertFalse(monitor.reported)
+
+    @defer.inlineCallbacks
+    def test_profiler(self):
+        clock = task.Clock()
+        directory = self.mktemp()
+        profiler = diagnostics.Profiler(directory, seconds=5, clock=clock)
+
+        d = profiler.run()
+        self.failureResultOf(profiler.run())
+        json.dumps({'profiled': range(100)})
+        clock.advance(5)
+
+        path = yield d
+        self.assertEquals(os.path.dirname(path), directory)
+        stats = pstats.Stats(path)
+        self.assertTrue(stats.total_calls)
+
+    @defer.inlineCallbacks
+    def test_drain_restore(self):
+        """
+        Drain unmounts every volume and restore mounts them again with the
+        references they held
+        """
+        forks = []
+
+        def fork(executable, args=(), **kw):
+            forks.append((executable, args[-1]))
+            if executable == '/bin/umount' and (
+                    args[-1] == '/tmp/docker-xylem-test/othervol'):
+                return defer.succeed(("", "busy", 16))
+            return defer.succeed(("", "", 0))
+
+        self.service._fork = fork
+        self.service.old_paths = []
+        for name, mount_id in [('testvol', 'a'), ('testvol', 'b'),
+                               ('othervol', 'c')]:
+            yield self.service._route_request(FakeRequest(
+                '/VolumeDriver.Mount', {'Name': name, 'ID': mount_id}))
+        del forks[:]
+
+        result = yield self.service.drain(concurrency=2)
+        self.assertEquals(result['total'], 2)
+        self.assertEquals(result['done'], 1)
+        self.assertEquals(result['failed'].keys(), ['othervol'])
+        self.assertEquals(self.service.current.keys(), ['othervol'])
+        self.assertEquals(sorted(forks), [
+            ('/bin/umount', '/tmp/docker-xylem-test/othervol'),
+            ('/bin/umount', '/tmp/docker-xylem-test/testvol'),
+        ])
+
+        del forks[:]
+        result = yield self.service.restore()
+        self.assertEquals(result['done'], 2)
+        self.assertEquals(result['failed'], {})
+        self.assertEquals(
+            forks, [('/bin/mount', '/tmp/docker-xylem-test/testvol')])
+        self.assertEquals(self.service.mount_refs['testvol'], set(['a', 'b']))
+        self.assertEquals(self.service.drained, {})
+
+    def test_control_resource(self):
+        resource = control.ControlResource(self.service)
+        self.service.drain = lambda concurrency: self.service._start_bulk(
+            'drain', ['testvol'])
+
+        def post(path, body):
+            request = DummyRequest([''])
+            request.path = path
+            request.content = StringIO(body)
+            return request, json.loads(resource.render_POST(request))
+
+        request, body = post('/drain', '{"concurrency": 4}')
+        self.assertEquals(request.responseCode, 202)
+        self.assertEquals(body['last']['running'], True)
+
+        request, body = post('/drain', '')
+        self.assertEquals(request.responseCode, 409)
+        self.assertEquals(body['error'], 'A drain is already running')
+
+        self.service.operation.record('testvol')
+        self.service.operation.finish()
+        request = DummyRequest([''])
+        request.path = '/status'
+        body = json.loads(resource.render_GET(request))
+        self.assertEquals(body['last']['running'], False)
+        self.assertEquals(body['last']['done'], 1)
@@ -0,0 +1,160 @@
+"""
+Per-request traces recording how long each phase of a Docker call took.
+"""
+
+import json
+import uuid
+import socket
+
+from twisted.internet import defer, reactor
+from twisted.python import failure, logfile
+
+from docker_xylem.compat import Logger
+from docker_xylem.logs import BufferedLogWriter
+
+# Header carrying the trace id on requests to xylem
+TRACE_HEADER = 'X-Trace-Id'
+
+
+class Span(object):
+    def __init__(self, trace, name, attrs):
+        self.trace = trace
+        self.name = name
+        self.attrs = attrs
+        self.start = None
+        self.duration = None
+        self.error = None
+
+    def run(self, f, *args, **kw):
+        """ Call `f` and record how long it and its Deferred take
+        """
+        clock = self.trace.clock
+        self.start = clock.seconds()
+
+        def finished(result):
+            self.duration = clock.seconds() - self.start
+            if isinstance(result, failure.Failure):
+                self.error = str(result.value)
+            return result
+
+        self.trace.spans.append(self)
+        return defer.maybeDeferred(f, *args, **kw).addBoth(finished)
+
+    def to_dict(self):
+        span = {
+            'name': self.name,
+            'start': self.start - self.trace.start,
+            'duration': self.duration,
+        }
+        if self.attrs:
+            span['attrs'] = self.attrs
+        if self.error:
+            span['error'] = self.error
+        return span
+
+
+class Trace(object):
+    """ Spans recorded while handling one Docker call
+    """
+    def __init__(self, tracer, name):
+        self.tracer = tracer
+        self.clock = tracer.clock
+        self.id = uuid.uuid4().hex
+        self.name = name
+        self.start = self.clock.seconds()
+        self.spans = []
+
+    def span(self, name, **attrs):
+        return Span(self, name, attrs)
+
+    def finish(self, error=None):
+        self.tracer.export({
+            'trace_id': self.id,
+            'name': self.name,
+            'start': self.start,
+            'duration': self.clock.seconds() - self.start,
+            'error': error,
+            'spans': [s.to_dict() for s in self.spans],
+        })
+
+
+class NullSpan(object):
+    def run(self, f, *args, **kw):
+        return defer.maybeDeferred(f, *args, **kw)
+
+
+class NullTrace(object):
+    """ Trace used when tracing is disabled, records nothing
+    """
+    id = None
+
+    def span(self, name, **attrs):
+        return NullSpan()
+
+    def finish(self, error=None):
+        pass
+
+
+NULL_TRACE = NullTrace()
+
+
+class FileExporter(object):
+    """ Writes traces as JSON lines to a file which is rotated once it
+    reaches `max_bytes`, keeping `backups` old files
+    """
+    def __init__(self, path, max_bytes=10 * 1024 * 1024, backups=5):
+        self.writer = BufferedLogWriter(logfile.LogFile.fromFullPath(
+            path, rotateLength=max_bytes, maxRotatedFiles=backups))
+
+    def __call__(self, trace):
+        self.writer.write(json.dumps(trace) + '\n')
+
+    def stop(self):
+        self.writer.stop()
+
+
+class SocketExporter(object):
+    """ Sends each trace as a JSON datagram to a local collector listening
+    on a UNIX socket path or a host:port UDP address
+    """
+    def __init__(self, address):
+        self.log = Logger()
+        if ':' in address:
+            host, port = address.rsplit(':', 1)
+            self.address = (host, int(port))
+            self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        else:
+            self.address = address
+            self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.socket.setblocking(False)
+
+    def __call__(self, trace):
+        try:
+            self.socket.sendto(json.dumps(trace), self.address)
+        except socket.error, e:
+            # The collector is best effort, never hold up a request for it
+            self.log.debug('Dropped trace: {e}', e=e)
+
+    def stop(self):
+        self.socket.close()
+
+
+class Tracer(object):
+    """ Starts traces and hands finished ones to the exporters
+    """
+    def __init__(self, exporters=(), clock=reactor):
+        self.exporters = list(exporters)
+        self.clock = clock
+
+    def trace(self, name):
+        if not self.exporters:
+            return NULL_TRACE
+        return Trace(self, name)
+
+    def export(self, trace):
+        for exporter in self.exporters:
+            exporter(trace)
+
+    def stop(self):
+        for exporter in self.exporters:
+            exporter.stop()
@@ -1,16 +1,39 @@
+import os
+import sys
 import json
+import random
+import itertools
+import collections
 
 from StringIO import StringIO
 
 from zope.interface import implements
 
-from twisted.internet import reactor, protocol, defer, error
+from twisted.internet import reactor, protocol, defer, error, task
+from twisted.python import failure
 from twisted.web.http_headers import Headers
 from twisted.web.iweb import IBodyProducer
-from twisted.web.client import Agent
+from twisted.web.client import (
+    Agent, HTTPConnectionPool, ResponseFailed, ResponseNeverReceived,
+    RequestTransmissionFailed)
 from twisted.internet.endpoints import clientFromString
 
+from docker_xylem import mount_helper
 from docker_xylem.compat import Logger
+from docker_xylem.metrics import REGISTRY
+
+FORK_SECONDS = REGISTRY.histogram(
+    'docker_xylem_fork_seconds',
+    'Run time of processes forked by the plugin', ['executable'])
+FORK_EXITS = REGISTRY.counter(
+    'docker_xylem_fork_exits_total',
+    'Exit codes of processes forked by the plugin', ['executable', 'code'])
+HTTP_SECONDS = REGISTRY.histogram(
+    'docker_xylem_http_request_seconds',
+    'Round trip time of outgoing HTTP requests', ['method'])
+HTTP_TIMEOUTS = REGISTRY.counter(
+    'docker_xylem_http_timeouts_total',
+    'Outgoing HTTP requests which timed out', ['method'])
 
 
 class SocketyAgent(Agent):
@@ -18,7 +41,8 @@ class SocketyAgent(Agent):
         self.path = path
         Agent.__init__(self, reactor, **kwargs)
 
-    def _getEndpoint(self, scheme, host, port):
+    def _getEndpoint(self, *args):
+        # Newer Twisted passes a URI, older passes scheme, host and port
         client = clientFromString(reactor, self.path)
         return client
 
@@ -29,18 +53,98 @@ class Timeout(Exception):
     """
 
 
+class MountError(Exception):
+    """
+    Raised when mount exits with an error, `code` is its exit status.
+    """
+    def __init__(self, message, code):
+        Exception.__init__(self, message)
+        self.code = code
+
+
+class BodyTooLarge(Exception):
+    """
+    Raised when an HTTP response body exceeds the allowed size.
+    """
+
+
 class BodyReceiver(protocol.Protocol):
-    """ Simple buffering consumer for body objects """
-    def __init__(self, finished):
+    """ Simple buffering consumer for body objects
+
+    If `max_size` is given the response is aborted, and `finished` errbacks
+    with BodyTooLarge, as soon as more than `max_size` bytes arrive.
+    """
+    def __init__(self, finished, max_size=None):
         self.finished = finished
-        self.buffer = StringIO()
+        self.max_size = max_size
+        self.chunks = []
+        self.size = 0
 
     def dataReceived(self, buffer):
-        self.buffer.write(buffer)
+        if self.finished is None:
+            return
+
+        self.size += len(buffer)
+        if self.max_size and (self.size > self.max_size):
+            self.chunks = []
+            finished, self.finished = self.finished, None
+            self.transport.stopProducing()
+            finished.errback(BodyTooLarge(
+                "Response body larger than %s bytes" % self.max_size))
+            return
+
+        self.chunks.append(buffer)
 
     def connectionLost(self, reason):
-        self.buffer.seek(0)
-        self.finished.callback(self.buffer)
+        if self.finished is not None:
+            self.finished.callback(StringIO(''.join(self.chunks)))
+
+
+class CappedBuffer(object):
+    """ Write-only buffer which keeps at most `limit` bytes, made up of the
+    start and the end of everything written to it
+    """
+    marker = '\n[... %s bytes truncated ...]\n'
+
+    def __init__(self, limit=65536):
+        self.head_limit = limit // 2
+        self.tail_limit = limit - self.head_limit
+        self.head = []
+        self.head_size = 0
+        self.tail = collections.deque()
+        self.tail_size = 0
+        self.truncated = 0
+
+    def write(self, data):
+        if self.head_size < self.head_limit:
+            chunk = data[:self.head_limit - self.head_size]
+            self.head.append(chunk)
+            self.head_size += len(chunk)
+            data = data[len(chunk):]
+
+        if not data:
+            return
+
+        self.tail.append(data)
+        self.tail_size += len(data)
+
+        while self.tail_size > self.tail_limit:
+            excess = self.tail_size - self.tail_limit
+            chunk = self.tail[0]
+            if len(chunk) <= excess:
+                self.tail.popleft()
+                dropped = len(chunk)
+            else:
+                self.tail[0] = chunk[excess:]
+                dropped = excess
+            self.tail_size -= dropped
+            self.truncated += dropped
+
+    def getvalue(self):
+        value = ''.join(self.head)
+        if self.truncated:
+            value += self.marker % self.truncated
+        return value + ''.join(self.tail)
 
 
 class StringProducer(object):
@@ -65,14 +169,14 @@ class StringProducer(object):
 
 class ProcessProtocol(protocol.ProcessProtocol):
     """ProcessProtocol which supports timeouts"""
-    def __init__(self, deferred, timeout):
+    def __init__(self, deferred, timeout, buffer_size=65536):
         self.log = Logger()
         self.timeout = timeout
         self.timer = None
 
         self.deferred = deferred
-        self.outBuf = StringIO()
-        self.errBuf = StringIO()
+        self.outBuf = CappedBuffer(buffer_size)
+        self.errBuf = CappedBuffer(buffer_size)
         self.outReceived = self.outBuf.write
         self.errReceived = self.errBuf.write
 
@@ -106,7 +210,49 @@ class ProcessProtocol(protocol.ProcessProtocol):
         self.timer = reactor.callLater(self.timeout, killIfAlive)
 
 
-def fork(executable, args=(), env={}, path=None, timeout=3600):
+def deadline(d, seconds, message, clock=reactor):
+    """ Returns a Deferred firing with the result of `d`, or failing with
+    `Timeout` if `d` has not fired within `seconds`
+
+    `d` is not cancelled, for calls such as a process stuck in the kernel
+    which cannot be stopped. Its result is dropped if it fires late.
+    """
+    result = defer.Deferred()
+    timer = clock.callLater(
+        seconds, lambda: result.errback(Timeout(message)))
+
+    def finished(value):
+        if timer.active():
+            timer.cancel()
+            if isinstance(value, failure.Failure):
+                result.errback(value)
+            else:
+                result.callback(value)
+
+    d.addBoth(finished)
+    return result
+
+
+def observe_fork(d, executable):
+    """ Record the run time and exit code of the process `d` waits on
+    """
+    start = reactor.seconds()
+
+    def observe(result):
+        FORK_SECONDS.observe(
+            reactor.seconds() - start, executable=executable)
+        if isinstance(result, failure.Failure):
+            code = 'signal'
+        else:
+            code = result[2]
+        FORK_EXITS.inc(executable=executable, code=code)
+        return result
+
+    return d.addBoth(observe)
+
+
+def fork(executable, args=(), env={}, path=None, timeout=3600,
+         buffer_size=65536):
     """fork
     Provides a deferred wrapper function with a timeout function
 
@@ -118,13 +264,133 @@ def fork(executable, args=(), env={}, path=None, timeout=3600):
     :type env: dict.
     :param timeout: Kill the child process if timeout is exceeded
     :type timeout: int.
+    :param buffer_size: Bytes of stdout and stderr kept from the child
+    :type buffer_size: int.
     """
-    d = defer.Deferred()
-    p = ProcessProtocol(d, timeout)
+    d = observe_fork(defer.Deferred(), executable)
+    p = ProcessProtocol(d, timeout, buffer_size)
     reactor.spawnProcess(p, executable, (executable,)+tuple(args), env, path)
     return d
 
 
+class SingleFlight(object):
+    """Coalesces concurrent calls for the same key into a single call whose
+    result is shared by every caller
+    """
+    def __init__(self):
+        self.pending = {}
+
+    def __len__(self):
+        return len(self.pending)
+
+    def __contains__(self, key):
+        return key in self.pending
+
+    def run(self, key, f, *args, **kw):
+        """Call `f` unless a call for `key` is already in flight, in which
+        case wait for that call instead
+
+        :param key: Identifies calls which are equivalent
+        :param f: Callable returning a value or a Deferred
+        """
+        if key in self.pending:
+            d = defer.Deferred()
+            self.pending[key].append(d)
+            return d
+
+        waiters = self.pending[key] = []
+
+        def finished(result):
+            del self.pending[key]
+            for d in waiters:
+                if isinstance(result, failure.Failure):
+                    d.errback(result)
+                else:
+                    d.callback(result)
+            return result
+
+        return defer.maybeDeferred(f, *args, **kw).addBoth(finished)
+
+
+# Errors from a request which may succeed if it is made again
+TRANSIENT_HTTP_ERRORS = (
+    Timeout,
+    error.ConnectError,
+    error.ConnectionLost,
+    ResponseFailed,
+    ResponseNeverReceived,
+    RequestTransmissionFailed,
+)
+
+
+def transient_http_error(e):
+    return isinstance(e, TRANSIENT_HTTP_ERRORS)
+
+
+# Messages from mount which mean the gluster servers could not be reached
+TRANSIENT_MOUNT_ERRORS = (
+    'connection refused',
+    'connection timed out',
+    'no route to host',
+    'network is unreachable',
+    'transport endpoint is not connected',
+    'failed to fetch volume file',
+    "failed to get the 'volume file' from server",
+)
+
+
+def transient_mount_error(e):
+    # mount exits with 32 for any failed mount, including a bad volume name
+    # or options, so only retry when gluster was unreachable
+    if not isinstance(e, MountError):
+        return False
+    message = str(e).lower()
+    return any(m in message for m in TRANSIENT_MOUNT_ERRORS)
+
+
+class RetryPolicy(object):
+    """Retries calls which fail with errors `retryable` accepts
+
+    Retries wait a random time up to a delay which starts at `initial` and
+    doubles up to `maximum` seconds. No retry is made which would start
+    more than `budget` seconds after the first attempt.
+    """
+    def __init__(self, retryable, budget=30, initial=0.5, maximum=5,
+                 clock=reactor):
+        self.log = Logger()
+        self.retryable = retryable
+        self.budget = budget
+        self.initial = initial
+        self.maximum = maximum
+        self.clock = clock
+
+    @defer.inlineCallbacks
+    def run(self, f, *args, **kw):
+        """Call `f`, retrying it until it succeeds, fails with an error
+        which is not retryable or the time budget is spent
+        """
+        deadline = self.clock.seconds() + self.budget
+        delay = self.initial
+        attempt = 1
+        while True:
+            try:
+                result = yield defer.maybeDeferred(f, *args, **kw)
+            except Exception, e:
+                wait = random.uniform(0, delay)
+                if not self.retryable(e) or (
+                        self.clock.seconds() + wait > deadline):
+                    raise
+
+                self.log.warn(
+                    'Attempt {attempt} failed, retrying in {wait:.2f}s. '
+                    '\"{e}\"', attempt=attempt, wait=wait, e=e)
+                yield task.deferLater(self.clock, wait, lambda: None)
+                delay = min(delay * 2, self.maximum)
+                attempt += 1
+            else:
+                defer.returnValue(result)
+
+
 try:
     from twisted.internet.ssl import ClientContextFactory
 
@@ -143,9 +409,142 @@ except:
     pass
 
 
+class MountHelper(protocol.ProcessProtocol):
+    """Runs commands through a long lived docker_xylem.mount_helper process
+    instead of forking the plugin for each one
+
+    :param allowed: Executables the helper may run
+    :type allowed: tupple.
+    :param stop_timeout: Seconds `stop` waits for running commands before
+        killing the helper
+    :type stop_timeout: int.
+    """
+    def __init__(self, allowed=('/bin/mount', '/bin/umount'),
+                 stop_timeout=30):
+        self.log = Logger()
+        self.allowed = tuple(allowed)
+        self.stop_timeout = stop_timeout
+        self.ids = itertools.count()
+        self.pending = {}
+        self.buffer = ''
+        self.running = False
+        self.stopped = None
+
+    def start(self):
+        self.buffer = ''
+        self.running = True
+        self.stopped = defer.Deferred()
+        reactor.spawnProcess(
+            self, sys.executable,
+            (sys.executable, mount_helper.SCRIPT) + self.allowed,
+            env=os.environ)
+
+    def stop(self):
+        """ Close the helper once its running commands finish, or kill it
+        after `stop_timeout` seconds. Returns a Deferred which fires when it
+        has exited
+        """
+        if not self.running:
+            return defer.succeed(None)
+        self.transport.closeStdin()
+        timer = reactor.callLater(self.stop_timeout, self._kill)
+
+        def stopped(result):
+            if timer.active():
+                timer.cancel()
+            return result
+
+        return self.stopped.addBoth(stopped)
+
+    def _kill(self):
+        self.log.warn(
+            'Mount helper still running commands after {timeout}s, killing '
+            'it', timeout=self.stop_timeout)
+        try:
+            self.transport.signalProcess('KILL')
+        except error.ProcessExitedAlready:
+            pass
+
+    def run(self, executable, args=(), env={}, path=None, timeout=3600):
+        """ Run a command in the helper, returns a Deferred with the same
+        result as `fork`
+        """
+        if not self.running:
+            self.start()
+
+        command_id = next(self.ids)
+        d = self.pending[command_id] = defer.Deferred()
+        observe_fork(d, executable)
+        data = json.dumps({
+            'id': command_id,
+            'executable': executable,
+            'args': list(args),
+            'env': env,
+            'path': path,
+            'timeout': timeout,
+        })
+        self.transport.write('%d:%s,' % (len(data), data))
+        return d
+
+    def outReceived(self, data):
+        self.buffer += data
+        while ':' in self.buffer:
+            length, rest = self.buffer.split(':', 1)
+            if len(rest) <= int(length):
+                break
+            message, self.buffer = rest[:int(length)], rest[int(length) + 1:]
+            self.responseReceived(json.loads(message))
+
+    def responseReceived(self, response):
+        d = self.pending.pop(response.get('id'), None)
+        if d is None:
+            return
+
+        if 'error' in response:
+            d.errback(Exception(response['error']))
+        elif response.get('signal'):
+            d.errback(error.ProcessTerminated(signal=response['signal']))
+        else:
+            d.callback((
+                response['out'].encode('utf-8'),
+                response['err'].encode('utf-8'),
+                response['code']
+            ))
+
+    def errReceived(self, data):
+        self.log.error('Mount helper: {data}', data=data.strip())
+
+    def processEnded(self, reason):
+        self.running = False
+        pending, self.pending = self.pending, {}
+        for d in pending.values():
+            d.errback(Exception('Mount helper exited'))
+        self.stopped.callback(None)
+
+
+def connection_pool(persistent=True, max_per_host=2, idle_timeout=240):
+    """connection_pool
+    Creates an HTTP connection pool which keeps connections alive between
+    requests
+
+    :param persistent: Keep connections open after a request completes
+    :type persistent: bool.
+    :param max_per_host: Maximum idle connections cached for each host
+    :type max_per_host: int.
+    :param idle_timeout: Close cached connections idle for this many seconds
+    :type idle_timeout: int.
+    """
+    pool = HTTPConnectionPool(reactor, persistent=persistent)
+    pool.maxPersistentPerHost = max_per_host
+    pool.cachedConnectionTimeout = idle_timeout
+    return pool
+
+
 class HTTPRequest(object):
-    def __init__(self, timeout=120):
+    def __init__(self, timeout=120, pool=None, max_body=None):
         self.timeout = timeout
+        self.pool = pool
+        self.max_body = max_body
 
         self.log = Logger()
 
@@ -162,7 +561,7 @@ class HTTPRequest(object):
     def response(self, request):
         if request.length:
             d = defer.Deferred()
-            request.deliverBody(BodyReceiver(d))
+            request.deliverBody(BodyReceiver(d, self.max_body))
             b = yield d
             body = b.read()
         else:
@@ -174,22 +573,30 @@ class HTTPRequest(object):
         self.timedout = False
 
         if socket:
-            agent = SocketyAgent(reactor, socket)
+            agent = SocketyAgent(reactor, socket, pool=self.pool)
         else:
             if url[:5] == 'https':
                 if SSL:
-                    agent = Agent(reactor, WebClientContextFactory())
+                    agent = Agent(
+                        reactor, WebClientContextFactory(), pool=self.pool)
                 else:
                     self.log.error('HTTPS requested but not supported')
                     raise Exception('HTTPS requested but not supported')
             else:
-                agent = Agent(reactor)
+                agent = Agent(reactor, pool=self.pool)
 
+        start = reactor.seconds()
         request = agent.request(
             method, url,
             Headers(headers),
             StringProducer(data) if data else None)
 
+        def observe(result):
+            HTTP_SECONDS.observe(reactor.seconds() - start, method=method)
+            return result
+
+        request.addCallback(observe)
+
         if self.timeout:
             timer = reactor.callLater(
                 self.timeout, self.abort_request, request)
@@ -207,6 +614,7 @@ class HTTPRequest(object):
                              error.ConnectingCancelledError)
                 self.log.warn('Request took longer than {timeout} seconds',
                               timeout=self.timeout)
+                HTTP_TIMEOUTS.inc(method=method)
                 raise Timeout(
                     "Request took longer than %s seconds" % self.timeout)
 
@@ -16,6 +16,7 @@ setup(
         'twisted.plugins': ['twisted/plugins/docker_xylem_plugin.py']
     },
     include_package_data=True,
+    scripts=['scripts/docker-xylem-ctl'],
     install_requires=[
         'Twisted',
         'pyyaml'
@@ -4,11 +4,11 @@ from zope.interface import implements
 
 from twisted.python import filepath, usage
 from twisted.plugin import IPlugin
-from twisted.application.service import IServiceMaker
+from twisted.application.service import IServiceMaker, MultiService
 from twisted.application import internet
 from twisted.web import server
 
-from docker_xylem import service
+from docker_xylem import service, metrics, control
 
 
 class Options(usage.Options):
@@ -29,9 +29,41 @@ class DockerServiceMaker(object):
         if not sockfp.parent().exists():
             sockfp.parent().makedirs()
 
-        return internet.UNIXServer(
+        docker = service.DockerService(config)
+
+        top = MultiService()
+        service.DockerPluginService(docker).setServiceParent(top)
+        internet.UNIXServer(
             config.get('socket', sockfp.path),
-            server.Site(service.DockerService(config)))
+            server.Site(docker)).setServiceParent(top)
+
+        if config.get('metrics_port'):
+            internet.TCPServer(
+                config['metrics_port'],
+                server.Site(metrics.MetricsResource()),
+                interface=config.get('metrics_interface', '127.0.0.1')
+            ).setServiceParent(top)
+
+        control_socket = config.get(
+            'control_socket', '/run/docker-xylem/control.sock')
+        if control_socket:
+            controlfp = filepath.FilePath(control_socket)
+            if not controlfp.parent().exists():
+                controlfp.parent().makedirs()
+            internet.UNIXServer(
+                controlfp.path,
+                server.Site(control.ControlResource(docker)),
+                mode=0600
+            ).setServiceParent(top)
+
+        if config.get('health_port'):
+            internet.TCPServer(
+                config['health_port'],
+                server.Site(service.HealthResource(docker)),
+                interface=config.get('health_interface', '127.0.0.1')
+            ).setServiceParent(top)
+
+        return top
 
 
 serviceMaker = DockerServiceMaker()